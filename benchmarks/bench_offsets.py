@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+# Micro-benchmark of the buffer's position conversions.
+#
+# Measures Buffer.get_file_pos / Buffer.get_file_x_y and typing a char near
+# the end of the file for 1k, 100k and 1M lines buffers, once with the plain
+# list storage and once with the rope storage.
+#
+# usage: python benchmarks/bench_offsets.py [lines ...]
+from os import path
+import time
+import sys
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+
+from fork.settings import get_settings
+from fork.buffer import Buffer
+
+LINE = "    some_function(argument_1, argument_2) # comment\n"
+REPEAT = 100
+
+
+def _time(func, repeat=REPEAT):
+    start = time.perf_counter()
+    for _ in range(repeat): func()
+    return (time.perf_counter() - start) / repeat
+
+def bench(storage, num_of_lines):
+    get_settings()['storage'] = storage
+    buffer = Buffer(data_in_bytes=(LINE * num_of_lines).encode())
+
+    y = num_of_lines - 2
+    x = 10
+    pos = buffer.get_file_pos(x, y)
+
+    results = {}
+    results['get_file_pos'] = _time(lambda: buffer.get_file_pos(x, y))
+    results['get_file_x_y'] = _time(lambda: buffer.get_file_x_y(pos))
+    def type_char():
+        buffer.insert_char(x, y, 'a')
+        buffer.remove_char(x + 1, y)
+    results['insert_char'] = _time(type_char) / 2
+    return results
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 100000, 1000000]
+
+    print(f"{'storage':<8}{'lines':>10}{'get_file_pos':>16}{'get_file_x_y':>16}{'insert_char':>16}")
+    for num_of_lines in sizes:
+        for storage in ['list', 'rope']:
+            results = bench(storage, num_of_lines)
+            print(f"{storage:<8}{num_of_lines:>10}"
+                  f"{results['get_file_pos'] * 1e6:>14.1f}us"
+                  f"{results['get_file_x_y'] * 1e6:>14.1f}us"
+                  f"{results['insert_char'] * 1e6:>14.1f}us")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# Cold-start benchmark of the editor.
+#
+# Starts `fork <file>` in a fresh interpreter on a pseudo terminal, and
+# measures the time from the process start to the end of the first Tab.draw,
+# and how much of it is importing fork.editor.
+#
+# usage: python benchmarks/bench_startup.py [file] [runs]
+from select import select
+from os import path
+import statistics
+import time
+import pty
+import sys
+import os
+
+ROOT = path.join(path.dirname(path.abspath(__file__)), '..')
+
+CHILD = """
+import time
+start = time.perf_counter()
+import sys, os
+sys.path.insert(0, {root!r})
+import fork.editor
+imported = time.perf_counter()
+from fork.tab import Tab
+draw = Tab.draw
+def first_draw(self, *args, **kwargs):
+    draw(self, *args, **kwargs)
+    os.write({fd}, f"{{imported - start}} {{time.perf_counter() - start}}\\n".encode())
+    os._exit(0)
+Tab.draw = first_draw
+sys.argv = ['fork', {file_path!r}]
+fork.editor.main()
+"""
+
+
+def run(file_path):
+    read_fd, write_fd = os.pipe()
+    spawned = time.perf_counter()
+    pid, master_fd = pty.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.set_inheritable(write_fd, True)
+        code = CHILD.format(root=ROOT, fd=write_fd, file_path=file_path)
+        os.execvp(sys.executable, [sys.executable, '-c', code])
+
+    os.close(write_fd)
+    # drain the terminal output so the child never blocks on it
+    data = b''
+    while b'\n' not in data:
+        ready, _, _ = select([master_fd, read_fd], [], [])
+        if master_fd in ready:
+            try: os.read(master_fd, 65536)
+            except OSError: pass
+        if read_fd in ready:
+            chunk = os.read(read_fd, 64)
+            if not chunk: break
+            data += chunk
+    total = time.perf_counter() - spawned
+    os.waitpid(pid, 0)
+    os.close(read_fd)
+    os.close(master_fd)
+
+    import_time, draw_time = (float(x) for x in data.split())
+    return import_time, draw_time, total
+
+def main():
+    file_path = sys.argv[1] if len(sys.argv) > 1 else path.join(ROOT, 'fork', 'buffer.py')
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    results = [run(path.abspath(file_path)) for _ in range(runs)]
+    import_time, draw_time, total = (statistics.median(r) for r in zip(*results))
+    print(f"{path.basename(file_path)}, median of {runs} runs:")
+    print(f"{'import fork.editor':<28}{import_time * 1e3:>8.1f}ms")
+    print(f"{'first Tab.draw':<28}{draw_time * 1e3:>8.1f}ms")
+    print(f"{'process start to first draw':<28}{total * 1e3:>8.1f}ms")
+
+if __name__ == '__main__':
+    main()
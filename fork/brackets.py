@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+from .storage import byte_column, char_column
+
+from functools import lru_cache
+
+BRACKETS = {'(': ')', '[': ']', '{': '}'}
+OPENING = {close: open for open, close in BRACKETS.items()}
+
+# how far the per line index is scanned for a pair before giving up.
+MAX_SCAN_LINES = 10000
+
+C_BLOCKS = (('/*', '*/'),)
+
+# language: (line comment markers, quote chars, blocks) the per line index
+# skips. Blocks, ((start, end), ...), are block comments and strings that
+# may span lines.
+LEXICAL = {
+    'python':       (('#',), '"\'', (('"""', '"""'), ("'''", "'''"))),
+    'bash':         (('#',), '"\'', ()),
+    'ruby':         (('#',), '"\'', ()),
+    'c':            (('//',), '"\'', C_BLOCKS),
+    'cpp':          (('//',), '"\'', C_BLOCKS),
+    'csharp':       (('//',), '"\'', C_BLOCKS),
+    'java':         (('//',), '"\'', C_BLOCKS),
+    'javascript':   (('//',), '"\'', C_BLOCKS + (('`', '`'),)),
+    'go':           (('//',), '"\'', C_BLOCKS + (('`', '`'),)),
+    'rust':         (('//',), '"', C_BLOCKS),
+    'zig':          (('//',), '"\'', ()),
+    'php':          (('//', '#'), '"\'', C_BLOCKS),
+    'css':          ((), '"\'', C_BLOCKS),
+    'json':         ((), '"', ()),
+}
+
+# node types of the tokens whose brackets are text, not code.
+LITERAL_TYPES = ('string', 'comment', 'char', 'rune')
+
+
+@lru_cache(maxsize=1 << 14)
+def line_brackets(line, comments=(), quotes='', blocks=(), block=None):
+    """
+    ((x, char), ...) of the brackets of line outside of quotes, line
+    comments and blocks, and the block still open at its end. block is the
+    index in blocks of the one open at its start, None if there is none.
+    Lines are immutable strings, so a line keeps its entry until it is
+    edited into a different string.
+    """
+    brackets = []
+    quote = None
+    starts = {start[0] for start, _ in blocks}
+    x = 0
+    while x < len(line):
+        if block is not None:
+            end = line.find(blocks[block][1], x)
+            if end == -1: break
+            x = end + len(blocks[block][1])
+            block = None
+            continue
+
+        c = line[x]
+        if quote:
+            if c == '\\': x += 1
+            elif c == quote: quote = None
+        elif c in starts and any(line.startswith(start, x) for start, _ in blocks):
+            block = next(i for i, (start, _) in enumerate(blocks) if line.startswith(start, x))
+            x += len(blocks[block][0])
+            continue
+        elif c in quotes: quote = c
+        elif c in BRACKETS or c in OPENING: brackets.append((x, c))
+        elif comments and any(line.startswith(comment, x) for comment in comments): break
+        x += 1
+    return tuple(brackets), block
+
+
+def _lexical(buffer):
+    return LEXICAL.get(buffer.language, ((), '', ()))
+
+def _lines_brackets(buffer, start_y, end_y, block=None):
+    """ (y, brackets) of the lines in [start_y, end_y), block is open at start_y """
+    comments, quotes, blocks = _lexical(buffer)
+    for y in range(start_y, end_y):
+        brackets, block = line_brackets(buffer.lines[y], comments, quotes, blocks, block)
+        yield y, brackets
+
+def _block_at(buffer, y):
+    """
+    the block open at the start of line y. Lines are read from at most
+    MAX_SCAN_LINES up, where no block is taken to be open.
+    """
+    comments, quotes, blocks = _lexical(buffer)
+    block = None
+    if not blocks: return block
+    for curr_y in range(max(0, y - MAX_SCAN_LINES), y):
+        _, block = line_brackets(buffer.lines[curr_y], comments, quotes, blocks, block)
+    return block
+
+def _use_tree(buffer):
+    # a tree waiting for its background reparse is not where the text is
+    return buffer.treesitter and buffer.treesitter.parsed
+
+def _tree_point(buffer, x, y):
+    return (y, byte_column(buffer.lines[y], x))
+
+def _tree_position(buffer, node):
+    y, x = node.start_point
+    return (char_column(buffer.lines[y], x), y)
+
+def _sibling_pair(node):
+    """ the bracket node that pairs node among its siblings, None if missing """
+    parent = node.parent
+    if not parent: return None
+    char = node.type
+    if char in BRACKETS:
+        pair, siblings = BRACKETS[char], parent.children
+    else:
+        pair, siblings = OPENING[char], list(reversed(parent.children))
+
+    depth = 0
+    found = False
+    for sibling in siblings:
+        if not found:
+            found = sibling == node
+            continue
+        if sibling.type == char: depth += 1
+        elif sibling.type == pair:
+            if depth == 0: return None if sibling.is_missing else sibling
+            depth -= 1
+    return None
+
+def _scan(buffer, x, y, char, forward):
+    """ the pair of the bracket char at (x, y) by the per line index """
+    pair = BRACKETS[char] if forward else OPENING[char]
+    if forward:
+        end_y = min(len(buffer.lines), y + MAX_SCAN_LINES)
+        lines = _lines_brackets(buffer, y, end_y, _block_at(buffer, y))
+    else:
+        lines = reversed(list(_lines_brackets(buffer, max(0, y - MAX_SCAN_LINES), y + 1)))
+
+    depth = 0
+    for curr_y, brackets in lines:
+        if not forward: brackets = reversed(brackets)
+        for curr_x, c in brackets:
+            if curr_y == y and (curr_x <= x if forward else curr_x >= x): continue
+            if c == char: depth += 1
+            elif c == pair:
+                if depth == 0: return (curr_x, curr_y)
+                depth -= 1
+    return None
+
+
+def match_bracket(buffer, x, y):
+    """ (x, y) of the bracket pairing the one at (x, y), None if there is none """
+    line = buffer.lines[y]
+    if x >= len(line): return None
+    char = line[x]
+    if char not in BRACKETS and char not in OPENING: return None
+
+    if _use_tree(buffer):
+        point = _tree_point(buffer, x, y)
+        node = buffer.treesitter.tree.root_node.descendant_for_point_range(point, point)
+        if node.type == char:
+            pair = _sibling_pair(node)
+            if pair: return _tree_position(buffer, pair)
+            if not node.parent or not node.parent.has_error: return None
+            # error recovery broke the pair apart, the index may still find it
+        elif any(kind in node.type for kind in LITERAL_TYPES): return None
+        # else in a token of its own, like the body of a C macro
+
+    comments, quotes, blocks = _lexical(buffer)
+    brackets, _ = line_brackets(line, comments, quotes, blocks, _block_at(buffer, y))
+    if (x, char) not in brackets: return None
+    return _scan(buffer, x, y, char, char in BRACKETS)
+
+def enclosing_brackets(buffer, x, y, char):
+    """
+    ((x, y), (x, y)) of the innermost char bracket pair around (x, y), a
+    bracket of that kind under (x, y) is its own pair.
+    """
+    close = BRACKETS[char]
+    if _use_tree(buffer):
+        point = _tree_point(buffer, x, y)
+        node = buffer.treesitter.tree.root_node.descendant_for_point_range(point, point)
+        while node:
+            for child in node.children:
+                if child.type != char or child.start_point > point: continue
+                pair = _sibling_pair(child)
+                if pair and point < pair.end_point:
+                    return (_tree_position(buffer, child), _tree_position(buffer, pair))
+            node = node.parent
+        return None
+
+    line = buffer.lines[y]
+    if x < len(line) and line[x] == char: end = _scan(buffer, x, y, char, True)
+    else: end = _scan(buffer, x - 1, y, char, True)
+    if not end: return None
+    start = _scan(buffer, end[0], end[1], close, False)
+    if not start: return None
+    return (start, end)
@@ -7,33 +7,111 @@ from .utils import *
 from .hooks import *
 from .idr import *
 
-from .treesitter import TreeSitter
+from .treesitter import TreeSitter, is_supported
+from .syntax import SyntaxCache
+from .brackets import match_bracket, enclosing_brackets
+from .highlights import Highlight, MatchCount, compile_pattern, line_matches, iter_matches
+from .storage import create_storage, map_file, byte_len
+from .undo import UndoTree, add_record, read_undo_file, write_undo_file
 from .common import Scope
+from .task import Task, post
 
-from difflib import Differ
-from subprocess import run
+from contextlib import contextmanager
 import hashlib
+import shutil
 import json
-import re
 import os
+import re
+
+# bytes of a large file sniffed for binary content.
+BINARY_SNIFF_SIZE = 64 * 1024
 
 WORD_REGEX = r'[a-zA-Z0-9_]'
 W_O_R_D_REGEX = r'[a-zA-Z0-9]'
 SINGLE_REGEX = r'[\)\(\}\{\]\[\,\.\/\"\'\;\:\=]'
 
 
+def _common_prefix(a, b):
+    """ length of the common prefix of a and b """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]: lo = mid
+        else: hi = mid - 1
+    return lo
+
+def _common_suffix(a, b, limit):
+    """ length of the common suffix of a and b, at most limit """
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]: lo = mid
+        else: hi = mid - 1
+    return lo
+
+def _edit_position(y, text, index):
+    """
+    byte offset and tree-sitter point (row, byte column) of text[index], where
+    text begins at the start of line y.
+    """
+    before = text[:index]
+    column = byte_len(before[before.rfind('\n') + 1:])
+    return byte_len(before), (y + before.count('\n'), column)
+
+def _edit_of(y, start_byte, old_lines, new_lines):
+    """
+    the tree-sitter edit of replacing old_lines with new_lines at line y,
+    which starts at start_byte. Only the part that differs is edited.
+    """
+    old = ''.join(old_lines)
+    new = ''.join(new_lines)
+
+    prefix = _common_prefix(old, new)
+    suffix = _common_suffix(old, new, min(len(old), len(new)) - prefix)
+    start, start_point = _edit_position(y, old, prefix)
+    old_end, old_end_point = _edit_position(y, old, len(old) - suffix)
+    new_end, new_end_point = _edit_position(y, new, len(new) - suffix)
+
+    change = {}
+    change['start_byte'] = start_byte + start
+    change['old_end_byte'] = start_byte + old_end
+    change['new_end_byte'] = start_byte + new_end
+    change['start_point'] = start_point
+    change['old_end_point'] = old_end_point
+    change['new_end_point'] = new_end_point
+    return change
+
+def _split_text(line, x):
+    """ split line at x, the second part keeps the indentation of the first """
+    first = line[:x] + '\n'
+    indent = len(first) - (len(first.lstrip()) if len(first.lstrip()) > 0 else 1)
+    second = first[:indent] + line[x:]
+    return first, second
+
+
 class Buffer():
     def on_buffer_change_callback(self, change):
         if change:
             if self.treesitter:
+                # a batch carries the edits of its every changed range
+                edits = change.get("edits", [change])
                 if get_setting('syntax') == 'sync':
                     if "all" not in change:
-                        self.treesitter.edit(change, self.get_file_bytes())
+                        self.treesitter.edit(edits, self.get_file_bytes())
                     else:
                         self.resync_treesitter()
                 elif get_setting('syntax') == 'async':
-                    pass # TODO
-        self.update_highlights()
+                    if "all" not in change:
+                        self.treesitter.edit_async( edits,
+                                                    self.snapshot,
+                                                    self.on_syntax_parsed)
+                    else:
+                        self.treesitter.resync_async(   self.snapshot,
+                                                        self.on_syntax_parsed)
+        self.update_highlights(change)
+
+    def on_syntax_parsed(self):
+        self._raise_event(ON_BUFFER_SYNTAX, None)
 
     def raise_event(func):
         def event_wrapper(self):
@@ -48,12 +126,85 @@ class Buffer():
         return event_wrapper
 
     def _raise_event(self, event, args):
+        # a batch reports its changes once, when it ends
+        if event == ON_BUFFER_CHANGE and self._batch is not None: return
         if event in self.events:
             for cb in self.events[event]: cb(args)
 
     def flush_changes(self, change={"all": True}):
         self._raise_event(ON_BUFFER_CHANGE, change)
 
+    @contextmanager
+    def batch(self):
+        """
+        Changes made in the block are reported once, when it ends, whatever
+        their propagate. The lines they touched are merged into ranges, and
+        the change carries one tree-sitter edit per range in "edits".
+        """
+        if self._batch is not None:
+            yield
+            return
+
+        self._batch = [] # [old_y, new_y, new_end_y, old_lines], by line
+        try: yield
+        finally:
+            ranges = self._batch
+            self._batch = None
+            if ranges: self._raise_event(ON_BUFFER_CHANGE, self._batch_change(ranges))
+
+    def _batch_add(self, y, count, new_lines):
+        """ merge the splice of count lines at y, before it is made, into the batch ranges """
+        ranges = self._batch
+        count = min(count, len(self.lines) - y)
+        end_y = y + count
+
+        # ranges overlapping the splice, or touching it
+        i = 0
+        while i < len(ranges) and ranges[i][2] < y: i += 1
+        j = i
+        while j < len(ranges) and ranges[j][1] <= end_y: j += 1
+
+        start_y = min([y] + [r[1] for r in ranges[i:j]])
+        stop_y = max([end_y] + [r[2] for r in ranges[i:j]])
+        # the lines between the ranges were not changed yet
+        old_lines = []
+        curr_y = start_y
+        for _, new_y, new_end_y, lines in ranges[i:j]:
+            old_lines.extend(self.lines[curr_y:new_y])
+            old_lines.extend(lines)
+            curr_y = new_end_y
+        old_lines.extend(self.lines[curr_y:stop_y])
+
+        shift = ranges[i - 1][2] - ranges[i - 1][0] - len(ranges[i - 1][3]) if i > 0 else 0
+        delta = len(new_lines) - count
+        for r in ranges[j:]:
+            r[1] += delta
+            r[2] += delta
+        ranges[i:j] = [[start_y - shift, start_y, stop_y + delta, old_lines]]
+
+    def _batch_change(self, ranges):
+        """
+        the change of a batch: the edits of its ranges, in order, each one
+        made after the ones before it, and around them the edit from the
+        first changed line to the last.
+        """
+        edits = [_edit_of(new_y, self.lines.byte_offset_of_line(new_y), old_lines, self.lines[new_y:new_end_y])
+                 for _, new_y, new_end_y, old_lines in ranges]
+        first = edits[0]
+        last = edits[-1]
+        byte_shift = sum(e['new_end_byte'] - e['old_end_byte'] for e in edits[:-1])
+        row_shift = sum(e['new_end_point'][0] - e['old_end_point'][0] for e in edits[:-1])
+
+        change = {}
+        change['start_byte'] = first['start_byte']
+        change['old_end_byte'] = last['old_end_byte'] - byte_shift
+        change['new_end_byte'] = last['new_end_byte']
+        change['start_point'] = first['start_point']
+        change['old_end_point'] = (last['old_end_point'][0] - row_shift, last['old_end_point'][1])
+        change['new_end_point'] = last['new_end_point']
+        change['edits'] = edits
+        return change
+
     def register_events(self, handlers):
         for event in handlers:
             if event not in self.events:
@@ -76,23 +227,29 @@ class Buffer():
     def __init__(self, file_path=None, data_in_bytes=None):
         Hooks.execute(ON_BUFFER_CREATE_BEFORE, self)
 
-        # When change is starting, this is where original is saved
         self.id = get_id(BUFFER_ID)
-        self.shadow = None
+        # When change is starting, this is where its splices are recorded
+        self.change_records = None
         self.change_start_position = None
-        self.undo_stack = []
-        self.redo_stack = []
+        self.undo_tree = UndoTree()
+        # the undo file is read on the first undo (or write), not on open
+        self.undo_file_loaded = False
+        self.undo_file_rewrite = False
 
-        self.highlights_meta = {}
-        self.highlights = []
+        self.highlights = {} # name: Highlight
+        self.match_counts = {} # (pattern, version): MatchCount
 
         self.visual_mode = None
         self.visual_scope = None
 
         self.events = {}
+        self._batch = None # changed line ranges while in a batch()
+        self.version = 0 # bumped by every change of the lines
         self.lines = []
         self.file_path = None
         self.in_memory_data = None
+        self.large_file = False
+        self._map_truncated = False
         self.hash = None
 
         if not file_path:
@@ -105,6 +262,12 @@ class Buffer():
             self.file_path = path.abspath(file_path)
             if not path.isfile(self.file_path):
                 self.lines = ['\n']
+            elif path.getsize(self.file_path) >= get_setting('large_file_size'):
+                if is_binary_file(self.file_path, BINARY_SNIFF_SIZE):
+                    elog("Failed loading binary file!")
+                    raise Exception('Not implemented!')
+                self.large_file = True
+                self.lines = map_file(self.file_path, self._on_map_truncated)
             elif is_binary_file(self.file_path):
                 elog("Failed loading binary file!")
                 raise Exception('Not implemented!')
@@ -118,12 +281,27 @@ class Buffer():
                     if self.lines[-1][-1] != '\n':
                         self.lines[-1] += '\n'
 
-            self.hash = self._hash_file()
+            if self.large_file:
+                # md5 releases the GIL, it is waited for on first use
+                self._hash_task = Task(lambda _: self._hash_file(), None)
+                self._hash_task.start()
+            else: self.hash = self._hash_file()
+        self.saved_version = self.version
 
         self.language = self.detect_language()
         self.treesitter = None
-        if self.language:
-            self.treesitter = TreeSitter(self.get_file_bytes(), self.language)
+        self.syntax_cache = None
+        # a large file is not parsed, that would read all of it
+        if self.language and is_supported(self.language) and not self.large_file:
+            # grammars load on first use, one that fails leaves us without syntax
+            try:
+                self.treesitter = TreeSitter( self.get_file_bytes(),
+                                              self.language,
+                                              lambda: self.lines)
+                self.syntax_cache = SyntaxCache(self.treesitter)
+            except Exception as e:
+                elog(f"no syntax for {self.language}: {e}")
+                self.treesitter = None
 
         self.cursors = []
 
@@ -137,10 +315,40 @@ class Buffer():
 
         Hooks.execute(ON_BUFFER_CREATE_AFTER, self)
 
+    @property
+    def lines(self): return self._text
+
+    @lines.setter
+    def lines(self, lines):
+        self._text = create_storage(lines)
+        self.version += 1
+
+    def snapshot(self):
+        """
+        the lines as they are now, for worker threads to read while the
+        buffer keeps changing. A result computed from a snapshot is stale
+        once its version is not the buffer's version.
+        """
+        return self.lines.snapshot(self.version)
+
+    @property
+    def hash(self):
+        if self._hash_task:
+            self._hash = self._hash_task.wait()
+            self._hash_task = None
+        return self._hash
+
+    @hash.setter
+    def hash(self, value):
+        self._hash_task = None
+        self._hash = value
+
     def _hash_file(self):
         try:
+            md5 = hashlib.md5()
             with open(self.file_path, 'rb') as h_file:
-                return hashlib.md5(h_file.read()).hexdigest()
+                for block in iter(lambda: h_file.read(1 << 20), b''): md5.update(block)
+            return md5.hexdigest()
         except: return None
 
     def _hash_local(self):
@@ -150,17 +358,29 @@ class Buffer():
 
     def _match_hash(self):
         try:
-            if path.exists(self.file_path):
-                with open(self.file_path, 'rb') as h_file:
-                    curr_hash = hashlib.md5(h_file.read()).hexdigest()
-                    return self.hash == curr_hash
+            if path.exists(self.file_path): return self.hash == self._hash_file()
             else: return True
         except: return False
 
     def is_there_local_change(self):
         if not self.file_path: return False
+        # not changed since read or written, no need to hash all of it
+        if self.version == self.saved_version: return False
         return not (self.hash == self._hash_local())
 
+    def _on_map_truncated(self):
+        # called as the lines are read, maybe on a worker thread
+        if self._map_truncated: return
+        self._map_truncated = True
+        post(self._reload_truncated)
+
+    def _reload_truncated(self):
+        """ the mapped file shrank under us, read it again unless it was edited """
+        if self.version != self.saved_version:
+            elog(f"{self.file_path} shrank on disk, the lines past its end are empty")
+            return
+        self.reload(force=True)
+
     def file_changed_on_disk(self):
         if not self.file_path: return False
         return not self._match_hash()
@@ -238,21 +458,12 @@ class Buffer():
 
     def get_file_pos(self, x, y):
         try:
-            for line in self.lines[:y]: x += len(line)
-            return x
+            return self.lines.offset_of_line(y) + x
         except: pass
         return -1
 
     def get_file_x_y(self, pos):
-        curr = 0
-        y = 0
-        for line in self.lines:
-            if curr <= pos < curr + len(line):
-                x = pos - curr
-                return (x, y)
-            curr += len(line)
-            y += 1
-        return None
+        return self.lines.position_of_offset(pos)
 
     def describe(self):
         if self.file_path:
@@ -264,13 +475,18 @@ class Buffer():
 
     def destroy(self):
         Hooks.execute(ON_BUFFER_DESTROY_BEFORE, self)
+        if self.treesitter: self.treesitter.close()
         Hooks.execute(ON_BUFFER_DESTROY_AFTER, self)
 
     def reload(self, force=False):
         if not force and self.file_changed_on_disk():
             return False
 
-        if self.file_path:
+        if self.large_file:
+            self._map_truncated = False
+            self.lines = map_file(self.file_path, self._on_map_truncated)
+            self.hash = self._hash_file()
+        elif self.file_path:
             with open(self.file_path, 'r') as f:
                 self.lines = f.readlines()
             self.hash = self._hash_file()
@@ -279,8 +495,10 @@ class Buffer():
                 return
         else:
             self.lines = self.in_memory_data.decode('utf-8').splitlines()
+        self.saved_version = self.version
 
         self.resync_treesitter()
+        self.update_highlights()
         self._raise_event(ON_BUFFER_RELOAD, None)
         return True
 
@@ -288,41 +506,93 @@ class Buffer():
         if not force and self.file_changed_on_disk():
             self.reload()
             # if file was changed under us,
-            # all our stack are irrelevant as the entire file's content might
-            # be compromised
-            self.undo_stack = []
-            self.redo_stack = []
+            # all our history is irrelevant as the entire file's content
+            # might be compromised
+            self.undo_tree = UndoTree()
+            self.undo_file_loaded = True
+            self.undo_file_rewrite = True
             return False
 
         if not self.file_path:
             self.in_memory_data = "\n".join(self.lines).encode('utf-8')
         else:
-            with open(self.file_path, 'w+') as f:
-                f.writelines(self.lines)
+            self._load_undo_file()
+            if self.large_file:
+                # the lines are read from the mapped file as they are written,
+                # the new content goes to a new file that replaces it.
+                tmp_path = f"{self.file_path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    f.writelines(self.lines)
+                shutil.copymode(self.file_path, tmp_path)
+                os.replace(tmp_path, self.file_path)
+            else:
+                with open(self.file_path, 'w+') as f:
+                    f.writelines(self.lines)
             self.hash = self._hash_file()
+            self._write_undo_file()
+        self.saved_version = self.version
         return True
 
-    def update_highlights(self):
-        self.highlights = []
-        for k in self.highlights_meta:
-            pattern, style = self.highlights_meta[k]
-            results = self.search_pattern(pattern)
-            if len(results) == 0: continue
-            for scope in results:
-                self.highlights.append((scope, style))
+    def _load_undo_file(self):
+        if self.undo_file_loaded: return
+        self.undo_file_loaded = True
+        # unless the history on disk is attached, the undo file starts over
+        self.undo_file_rewrite = True
+        if not self.file_path or not get_setting('undo_file'): return
+        if not self.hash: return
+
+        tree = read_undo_file(self.file_path, self.hash)
+        # the history on disk is from a different content, or our own history
+        # already lost its beginning so it can't be attached to it.
+        if not tree or self.undo_tree.root.seq != 0: return
+
+        tree.graft(self.undo_tree)
+        self.undo_tree = tree
+        self.undo_file_rewrite = False
+
+    def _write_undo_file(self):
+        if not get_setting('undo_file') or not self.hash: return
+        if write_undo_file( self.file_path,
+                            self.undo_tree,
+                            self.hash,
+                            rewrite=self.undo_file_rewrite):
+            self.undo_file_rewrite = False
+
+    def update_highlights(self, change=None):
+        for highlight in self.highlights.values(): highlight.on_change(change)
+
+    def match_count(self, pattern):
+        """
+        the MatchCount of pattern in the buffer as it is now, counted in the
+        background the first time it is asked for.
+        """
+        for key in [key for key in self.match_counts if key[1] != self.version]:
+            self.match_counts.pop(key).cancel()
+
+        key = (pattern, self.version)
+        count = self.match_counts.get(key)
+        if count: return count
+
+        count = MatchCount(pattern, self.version, get_setting('search_count_budget'))
+        self.match_counts[key] = count
+        count.start(self.snapshot(), self.on_match_count)
+        return count
+
+    def on_match_count(self, count):
+        if count.version != self.version: return
+        self._raise_event(ON_BUFFER_MATCH_COUNT, count)
 
     def clear_highlights(self):
-        self.highlights = []
-        self.highlights_meta = {}
+        self.highlights = {}
 
     def del_highlights(self, name):
-        if name in self.highlights_meta:
-            del self.highlights_meta[name]
-        self.update_highlights()
+        if name in self.highlights:
+            del self.highlights[name]
 
     def add_highlights(self, name, pattern, style):
-        self.highlights_meta[name] = (pattern, style)
-        self.update_highlights()
+        highlight = self.highlights.get(name)
+        if highlight and highlight.pattern == pattern and highlight.style == style: return
+        self.highlights[name] = Highlight(pattern, style)
 
     def clear_cursors(self):
         self.cursors = []
@@ -356,150 +626,166 @@ class Buffer():
         self.visual_scope = None
         self._raise_event(ON_BUFFER_CHANGE, None)
 
+    def _splice(self, y, count, new_lines, record=True):
+        """
+        Replace count lines starting at line y with new_lines. Every CORE
+        change ends up here, the returned change is the tree-sitter edit of
+        it: offsets in utf-8 bytes and points in (row, byte column). In a
+        batch, the batch makes the edit and None is returned. Without record,
+        the splice is not part of the change being recorded for undo.
+        """
+        y = min(y, len(self.lines))
+        new_lines = list(new_lines)
+        if self._batch is not None:
+            self._batch_add(y, count, new_lines)
+            start_byte = None
+        else: start_byte = self.lines.byte_offset_of_line(y)
+        old_lines = self.lines.splice(y, count, new_lines)
+        self.version += 1
+        if record and self.change_records is not None:
+            add_record(self.change_records, y, old_lines, new_lines)
+
+        if start_byte is None: return None
+        return _edit_of(y, start_byte, old_lines, new_lines)
+
     def _insert_char_to_line(self, x, y, char):
         try:
             line = self.lines[y]
             line = line[:x] + char + line[x:]
-            self.lines[y] = line
-            return True
-        except: return False
+            return self._splice(y, 1, [line])
+        except: return None
 
     def _insert_string_to_line(self, x, y, string):
         try:
             line = self.lines[y]
             line = line[:x] + string + line[x:]
-            self.lines[y] = line
-            return True
-        except: return False
+            return self._splice(y, 1, [line])
+        except: return None
 
     def _split_line(self, x, y):
-        line = self.lines[y]
-        first = line[:x] + '\n'
-        indent = len(first) - (len(first.lstrip()) if len(first.lstrip()) > 0 else 1)
-        second = first[:indent]+line[x:]
-        self.lines[y] = first
-        self.lines.insert(y + 1, second)
+        return self._splice(y, 1, _split_text(self.lines[y], x))
 
     def _join_line(self, y):
         line = self.lines[y]
-        next_line = self.lines.pop(y + 1)
+        next_line = self.lines[y + 1]
         joined = line[:-1] + next_line
-        self.lines[y] = joined
+        return self._splice(y, 2, [joined])
+
+    def _replace_range(self, start_pos, end_pos, string):
+        """
+        Replace the text between the file positions [start_pos, end_pos) with
+        string. Only the lines the range spans are touched.
+        """
+        if len(self.lines) == 0:
+            return self._splice(0, 0, string.splitlines(keepends=True))
+
+        start = self.get_file_x_y(start_pos)
+        if start:
+            start_x, start_y = start
+            head = self.lines[start_y][:start_x]
+        else: # past the end of the file
+            start_y = len(self.lines) - 1
+            head = self.lines[start_y]
+
+        end = self.get_file_x_y(end_pos) if start else None
+        if end:
+            end_x, end_y = end
+            tail = self.lines[end_y][end_x:]
+        else: # past the end of the file
+            end_y = len(self.lines) - 1
+            tail = ''
+
+        text = head + string + tail
+        return self._splice(start_y,
+                            end_y - start_y + 1,
+                            text.splitlines(keepends=True))
 
     # CORE: change
     def remove_char(self, x, y, propagate=True):
-        start_byte = self.get_file_pos(x, y)
         if x == 0:
             if y == 0: return
-            new_x = len(self.lines[y - 1]) - 1
-            self._join_line(y - 1)
-            change = {
-                    'start_byte': start_byte,
-                    'old_end_byte': start_byte,
-                    'new_end_byte': start_byte - 1,
-                    'start_point': (y, x),
-                    'old_end_point': (y, x),
-                    'new_end_point': (y - 1, new_x),
-                    }
+            change = self._join_line(y - 1)
         else:
             line = self.lines[y]
             line = line[:x-1] + line[x:]
-            self.lines[y] = line
-
-            change = {
-                    'start_byte': start_byte,
-                    'old_end_byte': start_byte,
-                    'new_end_byte': start_byte - 1,
-                    'start_point': (y, x),
-                    'old_end_point': (y, x),
-                    'new_end_point': (y, x - 1),
-                    }
+            change = self._splice(y, 1, [line])
         if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
 
     # CORE: change
-    def insert_string(self, x, y, string, propagate=True):
-        start_byte = self.get_file_pos(x, y)
-        end_byte = start_byte + len(string)
-
+    def insert_string(self, x, y, string, propagate=True, keep_indent=True):
+        """
+        insert string at (x, y), return the position after it. With
+        keep_indent, every new line starts with the indentation of the line
+        it splits.
+        """
         if '\n' not in string and '\r' not in string:
-            self._insert_string_to_line(x, y, string)
+            change = self._insert_string_to_line(x, y, string)
             end_x = x + len(string)
             end_y = y
-            change = {
-                    'start_byte': start_byte,
-                    'old_end_byte': start_byte,
-                    'new_end_byte': end_byte,
-                    'start_point': (y, x),
-                    'old_end_point': (y, x),
-                    'new_end_point': (end_y, end_x),
-                    }
+        elif not keep_indent:
+            line = self.lines[y]
+            lines = (line[:x] + string + line[x:]).split('\n')
+            lines = [l + '\n' for l in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+            end_x = len(string) - string.rfind('\n') - 1
+            end_y = y + string.count('\n')
+            change = self._splice(y, 1, lines)
         else:
+            lines = [self.lines[y]]
             end_x = x
-            end_y = y
             while string.find('\n') != -1:
                 to_insert = string[:string.find('\n')]
-                self._insert_string_to_line(end_x, end_y, to_insert)
+                line = lines[-1]
+                line = line[:end_x] + to_insert + line[end_x:]
                 end_x += len(to_insert)
-                self._split_line(end_x, end_y)
-                end_y += 1
+                lines[-1:] = _split_text(line, end_x)
                 end_x = 0
                 string = string[string.find('\n') + 1:]
 
             if len(string) > 0:
-                self._insert_string_to_line(end_x, end_y, string)
+                line = lines[-1]
+                lines[-1] = line[:end_x] + string + line[end_x:]
                 end_x += len(string)
 
-            change = {
-                    'start_byte': start_byte,
-                    'old_end_byte': start_byte,
-                    'new_end_byte': end_byte,
-                    'start_point': (y, x),
-                    'old_end_point': (y, x),
-                    'new_end_point': (end_y, end_x),
-                    }
+            end_y = y + len(lines) - 1
+            change = self._splice(y, 1, lines)
 
         if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
         return end_x, end_y
 
     # CORE: change
     def insert_char(self, x, y, char, propagate=True):
-        start_byte = self.get_file_pos(x, y)
         if char == '\n' or char == '\r':
-            self._split_line(x, y)
-            change = {
-                    'start_byte': start_byte,
-                    'old_end_byte': start_byte,
-                    'new_end_byte': start_byte + 1,
-                    'start_point': (y, x),
-                    'old_end_point': (y, x),
-                    'new_end_point': (y + 1, 0),
-                    }
+            change = self._split_line(x, y)
         else:
-            self._insert_char_to_line(x, y, char)
-            change = {
-                    'start_byte': start_byte,
-                    'old_end_byte': start_byte,
-                    'new_end_byte': start_byte + 1,
-                    'start_point': (y, x),
-                    'old_end_point': (y, x),
-                    'new_end_point': (y, x + 1),
-                    }
+            change = self._insert_char_to_line(x, y, char)
 
         if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
 
     # CORE: change
     def insert_line(self, y, new_line, propagate=True):
-        change = {}
-        start_byte = self.get_file_pos(0, y)
-        change['start_byte'] = start_byte
-        change['old_end_byte'] = start_byte
-        change['new_end_byte'] = start_byte + len(new_line)
+        change = self._splice(y, 0, [new_line])
+
+        if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
 
-        change['start_point'] = (y, 0)
-        change['old_end_point'] = (y, 0)
-        change['new_end_point'] = (y + 1, 0)
+    # CORE: change
+    def splice_lines(self, y, count, new_lines, propagate=True, record=True):
+        change = self._splice(y, count, new_lines, record=record)
+
+        if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
 
-        self.lines.insert(y, new_line)
+    # CORE: change
+    def drop_lines(self, count, propagate=True):
+        """
+        remove the first count lines, outside of undo. The windows of the
+        buffer move their cursors and jumps up with the lines.
+        """
+        change = self._splice(0, count, [], record=False)
+        self._load_undo_file()
+        # the history moves up with the lines, a history that changed the
+        # dropped lines can't be replayed anymore and starts over.
+        if not self.undo_tree.drop_lines(count): self.undo_tree = UndoTree()
+        self.undo_file_rewrite = True
+        self._raise_event(ON_BUFFER_LINES_DROPPED, count)
 
         if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
 
@@ -508,32 +794,11 @@ class Buffer():
         if y >= len(self.lines):
             raise Exception("remove_line(): y is out of range..?")
 
-        change = {}
-
         # last line in buffer?
         if y == 0 and len(self.lines) == 1:
-            line = self.lines[y]
-            start_byte = self.get_file_pos(0, y)
-
-            self.lines[y] = "\n" # keeping last line alive
-
-            change['start_byte'] = start_byte
-            change['old_end_byte'] = start_byte + len(line)
-            change['new_end_byte'] = start_byte + len(self.lines[y])
-            change['start_point'] = (y, 0)
-            change['old_end_point'] = (y, len(line))
-            change['new_end_point'] = (y, len(self.lines[y]))
+            change = self._splice(y, 1, ["\n"]) # keeping last line alive
         else:
-            line = self.lines[y]
-            start_byte = self.get_file_pos(0, y)
-            self.lines.pop(y)
-
-            change['start_byte'] = start_byte
-            change['old_end_byte'] = start_byte + len(line)
-            change['new_end_byte'] = start_byte
-            change['start_point'] = (y, 0)
-            change['old_end_point'] = (y, len(line))
-            change['new_end_point'] = (y, 0)
+            change = self._splice(y, 1, [])
 
         if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
         return min(y, len(self.lines) - 1)
@@ -547,18 +812,8 @@ class Buffer():
         end_pos = self.get_file_pos(scope.end.x, scope.end.y)
         if end_pos == -1: return 0
         end_pos += 1
-        stream = self.get_file_stream()
-
-        stream = stream[:start_pos] + stream[end_pos:]
-        self.lines = stream.splitlines(keepends=True)
 
-        change = {}
-        change['start_byte'] = start_pos
-        change['old_end_byte'] = end_pos
-        change['new_end_byte'] = start_pos
-        change['start_point'] = (scope.start.y, scope.start.x)
-        change['old_end_point'] = (scope.end.y, scope.end.x)
-        change['new_end_point'] = (scope.start.y, scope.start.x)
+        change = self._replace_range(start_pos, end_pos, '')
 
         if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
 
@@ -575,18 +830,9 @@ class Buffer():
         if end_pos == -1: return 0
         end_pos += 1
 
-        stream = self.get_file_stream()
+        change = self._replace_range(start_pos, end_pos, dest)
 
-        stream = stream[:start_pos] +   \
-                 dest +                 \
-                 stream[end_pos:]
-
-        self.lines = stream.splitlines(keepends=True)
-        stream = self.get_file_stream()
-
-        self.lines = stream.splitlines(keepends=True)
-
-        if propagate: self.flush_changes()
+        if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
 
     # CORE: change
     def search_replace_scope( self,
@@ -600,21 +846,13 @@ class Buffer():
         if end_pos == -1: return 0
         end_pos += 1
 
-        stream = self.get_file_stream()
-
-        part = stream[start_pos:end_pos]
-        part = re.sub(pattern, dest, part)
+        part = self.get_scope_text(scope)
+        if part is None: return 0
+        part = re.sub(pattern, dest, ''.join(part))
 
-        stream = stream[:start_pos] +   \
-                 part +                 \
-                 stream[end_pos:]
+        change = self._replace_range(start_pos, end_pos, part)
 
-        self.lines = stream.splitlines(keepends=True)
-        stream = self.get_file_stream()
-
-        self.lines = stream.splitlines(keepends=True)
-
-        if propagate: self.flush_changes()
+        if propagate: self._raise_event(ON_BUFFER_CHANGE, change)
 
     def replace_char(self, x, y, char, propagate=True):
         self.remove_char(x+1, y, propagate=propagate)
@@ -656,198 +894,75 @@ class Buffer():
         return text
 
     def _change(self, change, undo=True):
-        lines_for_deletion = []
-        lines_for_insertion = {}
-        lines_for_replacement = {}
-
-        _from = "new" if undo else "old"
-        _to = "old" if undo else "new"
-
-        for line_num in change:
-            # new lines needs to be removed
-            if  _from in change[line_num] and \
-                _to not in change[line_num]:
-                lines_for_deletion.append(line_num)
-
-            # changed lines needs to be replaced
-            elif    _from in change[line_num] and \
-                    _to in change[line_num]:
-                lines_for_replacement[line_num] = change[line_num][_to]
-
-            # removed lines neeeds to be reinserted
-            elif    _to in change[line_num] and \
-                    _from not in change[line_num]:
-                lines_for_insertion[line_num] = change[line_num][_to]
-
-        # lines removals must be in decreasing order to no mess up with the
-        # line numbers
-        for line in reversed(sorted(lines_for_deletion)):
-            self.remove_line(line, propagate=False)
-
-        # lines insertions must be in increasing order to no mess up with the
-        # line numbers
-        for line in sorted(lines_for_insertion):
-            self.insert_line(line, lines_for_insertion[line], propagate=False)
-
-        # for line replacements order is not important.
-        for line in lines_for_replacement:
-            self.replace_line(line, lines_for_replacement[line], propagate=False)
+        """
+        change is the list of (y, old_lines, new_lines) splices recorded
+        while the change was made, undo them in reverse order or redo them.
+        """
+        if undo:
+            records = [(y, new_lines, old_lines) for y, old_lines, new_lines in reversed(change)]
+        else:
+            records = change
 
-        self.flush_changes()
+        with self.batch():
+            for y, old_lines, new_lines in records: self._splice(y, len(old_lines), new_lines)
 
     def undo_prefetch(self):
-        if len(self.undo_stack) == 0: return None
-        change_wrapper = self.undo_stack[-1]
-        return change_wrapper['start_position']
-    def undo(self):
-        if len(self.undo_stack) == 0: return
-        change_wrapper = self.undo_stack.pop()
-        change = change_wrapper['change']
+        self._load_undo_file()
+        node = self.undo_tree.peek_undo()
+        if not node: return None
+        return node.start_position
 
-        self._change(change)
+    def undo(self):
+        self._load_undo_file()
+        node = self.undo_tree.undo()
+        if not node: return
 
-        self.redo_stack.append(change_wrapper)
-        return change_wrapper['start_position']
+        self._change(node.change)
+        return node.start_position
 
     def redo(self):
-        if len(self.redo_stack) == 0: return
-        change_wrapper = self.redo_stack.pop()
-        change = change_wrapper['change']
-
+        self._load_undo_file()
+        node = self.undo_tree.redo()
+        if not node: return
+
+        self._change(node.change, undo=False)
+        return node.end_position
+
+    def _travel(self, step):
+        self._load_undo_file()
+        to_undo, to_redo = self.undo_tree.travel(step)
+        if not to_undo and not to_redo: return None
+
+        change = []
+        for node in to_undo:
+            change.extend((y, new_lines, old_lines) for y, old_lines, new_lines in reversed(node.change))
+        for node in to_redo:
+            change.extend(node.change)
         self._change(change, undo=False)
 
-        self.undo_stack.append(change_wrapper)
-        return change_wrapper['end_position']
+        if to_redo: return to_redo[-1].end_position
+        return to_undo[-1].start_position
 
-    def change_begin(self, x, y):
-        self.shadow = self.lines.copy()
-        self.change_start_position = (x, y)
-        self.redo_stack = [] # reset the redo stack on new edit.
+    def earlier(self, count=1):
+        """ go back to the state before the previous change, across branches """
+        return self._travel(-count)
 
-    def __analyze_change(self):
-        change = {}
-        open('/tmp/a.dif.tmp', 'w').write(''.join(self.shadow))
-        open('/tmp/b.dif.tmp', 'w').write(''.join(self.lines))
-
-        p = run(["diff", "/tmp/a.dif.tmp", "/tmp/b.dif.tmp"],
-                capture_output=True)
-        if p.returncode == 0: return change # unchanged.
-        if p.returncode != 1:
-            raise Exception("Failed to diff the edit!")
-
-        lines = p.stdout.decode().splitlines(keepends=True)
-        cur = 0
-        while cur < len(lines) - 1:
-            cmd = lines[cur]
-            m = re.match(r"^(?P<a_start>\d+)(,(?P<a_end>\d+))?(?P<cmd>[adc])(?P<b_start>\d+)(,(?P<b_end>\d+))?\s*$", cmd)
-            if not m:
-                raise Exception("Failed to diff the edit!")
-            a_start = int(m.group('a_start'))
-            a_end = m.group('a_end')
-            a_end = int(a_end) if a_end != None else a_start
-            cmd = m.group('cmd')
-            b_start = int(m.group('b_start'))
-            b_end = m.group('b_end')
-            b_end = int(b_end) if b_end != None else b_start
-
-            if cmd == 'a':
-                while b_start <= b_end:
-                    cur += 1
-                    if b_start-1 not in change: change[b_start-1] = {}
-                    line = lines[cur]
-                    if not line.startswith('> '):
-                        raise Exception("Failed to diff the edit!")
-                    change[b_start-1]['new'] = line[2:]
-                    b_start += 1
-                cur += 1
-            if cmd == 'd':
-                while a_start <= a_end:
-                    cur += 1
-                    if a_start-1 not in change: change[a_start-1] = {}
-                    line = lines[cur]
-                    if not line.startswith('< '):
-                        raise Exception("Failed to diff the edit!")
-                    change[a_start-1]['old'] = line[2:]
-                    a_start += 1
-                cur += 1
-            if cmd == 'c':
-                while a_start <= a_end:
-                    cur += 1
-                    if a_start-1 not in change: change[a_start-1] = {}
-                    line = lines[cur]
-                    if not line.startswith('< '):
-                        raise Exception("Failed to diff the edit!")
-                    change[a_start-1]['old'] = line[2:]
-                    a_start += 1
-                cur += 1
-                line = lines[cur]
-                if not line.startswith('---'):
-                    raise Exception("Failed to diff the edit!")
-                while b_start <= b_end:
-                    cur += 1
-                    if b_start-1 not in change: change[b_start-1] = {}
-                    line = lines[cur]
-                    if not line.startswith('> '):
-                        raise Exception("Failed to diff the edit!")
-                    change[b_start-1]['new'] = line[2:]
-                    b_start += 1
-                cur += 1
-
-        os.remove('/tmp/a.dif.tmp')
-        os.remove('/tmp/b.dif.tmp')
-        return change
-
-    def _analyze_change(self):
-        """
-        The change format is as follows:
-        A list of chnages per line:
-        [
-        <line_nume>, <old_line>, <new_line>
-        ...
-        <line_nume>, <old_line>, <new_line>
-        ]
-
-        In case there are no old/new line (removal/addition) the apropriate
-        action is done correspondingly.
-        """
-        return self.__analyze_change()
-        change = {}
+    def later(self, count=1):
+        """ go forward to the state after the next change, across branches """
+        return self._travel(count)
 
-        d = Differ()
-        old_line_num = 0
-        new_line_num = 0
-        for line in d.compare(self.shadow, self.lines):
-            if not (line.startswith('?') or \
-                    line.startswith('-') or \
-                    line.startswith('+')):
-                old_line_num += 1
-                new_line_num += 1
-                continue
-
-            if line.startswith('+'):
-                if new_line_num not in change: change[new_line_num] = {}
-
-                change[new_line_num]['new'] = line[2:]
-
-                new_line_num += 1
-            elif line.startswith('-'):
-                if old_line_num not in change: change[old_line_num] = {}
-
-                change[old_line_num]['old'] = line[2:]
-                old_line_num += 1
-
-        return change
+    def change_begin(self, x, y):
+        self.change_records = []
+        self.change_start_position = (x, y)
 
     def change_end(self, x, y):
-        change = self._analyze_change()
-        change_wrapper = {}
+        change = self.change_records
         if change:
-            change_wrapper['change'] = change
-            change_wrapper['start_position'] = self.change_start_position
-            change_wrapper['end_position'] = (x,y)
-            self.undo_stack.append(change_wrapper)
+            self.undo_tree.push(change,
+                                self.change_start_position,
+                                (x, y))
 
-        self.shadow = None
+        self.change_records = None
         self.change_start_position = None
 
     # CORE: movement
@@ -900,6 +1015,15 @@ class Buffer():
             found -= 1
         return None
 
+    # CORE: movement
+    def find_pair(self, x, y):
+        """ (x, y) of the bracket pairing the one at (x, y) """
+        return match_bracket(self, x, y)
+
+    def find_enclosing_pair(self, x, y, char):
+        """ ((x, y), (x, y)) of the innermost char brackets around (x, y) """
+        return enclosing_brackets(self, x, y, char)
+
     def find_prev_and_next_char(self, x, y, char):
         prev = self.find_prev_char(x, y, char)
         if not prev: return None
@@ -1140,10 +1264,9 @@ class Buffer():
         return Scope(start_x, start_y, end_x, end_y)
 
     def arround_parentheses(self, x, y):
-        prev = self.find_prev_char(x, y, '(', smart=True)
-        if not prev: return None
-        next = self.find_next_char(x, y, ')', smart=True)
-        if not next: return None
+        ret = self.find_enclosing_pair(x, y, '(')
+        if not ret: return None
+        prev, next = ret
         return Scope(prev[0], prev[1], next[0], next[1])
 
     def arround_quotation(self, x, y):
@@ -1152,17 +1275,15 @@ class Buffer():
         return Scope(ret[0][0], ret[0][1], ret[1][0], ret[1][1])
 
     def arround_square_brackets(self, x, y):
-        prev = self.find_prev_char(x, y, '[', smart=True)
-        if not prev: return None
-        next = self.find_next_char(x, y, ']', smart=True)
-        if not next: return None
+        ret = self.find_enclosing_pair(x, y, '[')
+        if not ret: return None
+        prev, next = ret
         return Scope(prev[0], prev[1], next[0], next[1])
 
     def arround_curly_brackets(self, x, y):
-        prev = self.find_prev_char(x, y, '{', smart=True)
-        if not prev: return None
-        next = self.find_next_char(x, y, '}', smart=True)
-        if not next: return None
+        ret = self.find_enclosing_pair(x, y, '{')
+        if not ret: return None
+        prev, next = ret
         return Scope(prev[0], prev[1], next[0], next[1])
 
     def arround_greater_than(self, x, y):
@@ -1411,17 +1532,17 @@ class Buffer():
         range = self.treesitter.get_arround_argument(x, y)
         return range
 
+    def search(self, pattern, x, y, forward=True):
+        """ (x, y) of the nearest match after (before) (x, y), wrapping around """
+        return next(iter_matches(self.lines, pattern, x, y, forward), None)
+
     def search_pattern(self, pattern):
         results = []
-        try:
-            for y, line in enumerate(self.lines):
-                for m in re.finditer(pattern, line):
-                    if m.lastindex:
-                        start_x, end_x = m.span(m.lastindex)
-                    else:
-                        start_x, end_x = m.span()
-                    results.append(Scope(start_x, y, end_x, y))
-        except: pass
+        regex = compile_pattern(pattern)
+        if not regex: return results
+        for y, line in enumerate(self.lines):
+            for start_x, end_x in line_matches(regex, line):
+                results.append(Scope(start_x, y, end_x, y))
         return results
 
 if __name__=='__main__':
@@ -3,17 +3,20 @@
 from string import printable
 import traceback
 import argparse
+import sys
 import json
 import re
 import os
 
 from .buffer import Buffer
+from .stream import Stream
 from .common import Scope
 from .settings import *
 from .task import Task
 from .screen import *
 from .log import elog
 from .tab import Tab
+from .render import defer, overlay
 
 from .events import *
 from .hooks import *
@@ -31,7 +34,6 @@ from .plugins import gd
 from .utils import *
 
 args = None
-pending_buffer = b''
 
 NORMAL = 'normal'
 INSERT = 'insert'
@@ -218,6 +220,7 @@ class Editor():
                 cb = callbacks.get(ord('j'), default_callback)
                 if cb is not None: return cb(scope)
         maps[ord('j')] = move_j
+        maps[KEY_DOWN] = move_j
         def move_k(self):
             src_x = self.get_curr_window().buffer_cursor[0]
             src_y = self.get_curr_window().buffer_cursor[1]
@@ -233,6 +236,7 @@ class Editor():
                 cb = callbacks.get(ord('k'), default_callback)
                 if cb is not None: return cb(scope)
         maps[ord('k')] = move_k
+        maps[KEY_UP] = move_k
         def move_h(self):
             src_x = self.get_curr_window().buffer_cursor[0]
             src_y = self.get_curr_window().buffer_cursor[1]
@@ -245,6 +249,7 @@ class Editor():
                 cb = callbacks.get(ord('h'), default_callback)
                 if cb is not None: return cb(scope)
         maps[ord('h')] = move_h
+        maps[KEY_LEFT] = move_h
         def move_l(self):
             src_x = self.get_curr_window().buffer_cursor[0]
             src_y = self.get_curr_window().buffer_cursor[1]
@@ -257,6 +262,7 @@ class Editor():
                 cb = callbacks.get(ord('h'), default_callback)
                 if cb is not None: return cb(scope)
         maps[ord('l')] = move_l
+        maps[KEY_RIGHT] = move_l
         def move_w(self):
             src_x = self.get_curr_window().buffer_cursor[0]
             src_y = self.get_curr_window().buffer_cursor[1]
@@ -547,16 +553,17 @@ class Editor():
             src_y = self.get_curr_window().buffer_cursor[1]
 
             char = self.get_curr_window().get_curr_line()[src_x]
-            dst_char = self.get_curr_buffer().negate_char(char)
-            if not dst_char: return False
-            if char in "(<{[":
-                ret = self.get_curr_buffer().find_next_char(src_x, src_y, dst_char, smart=True)
-                if not ret: return False
-                dst_x, dst_y = ret
+            if char in "(){}[]":
+                ret = self.get_curr_buffer().find_pair(src_x, src_y)
             else:
-                ret = self.get_curr_buffer().find_prev_char(src_x, src_y, dst_char, smart=True)
-                if not ret: return False
-                dst_x, dst_y = ret
+                dst_char = self.get_curr_buffer().negate_char(char)
+                if not dst_char: return False
+                if char == "<":
+                    ret = self.get_curr_buffer().find_next_char(src_x, src_y, dst_char, smart=True)
+                else:
+                    ret = self.get_curr_buffer().find_prev_char(src_x, src_y, dst_char, smart=True)
+            if not ret: return False
+            dst_x, dst_y = ret
             scope = Scope(src_x, src_y, dst_x, dst_y)
             if scope:
                 cb = callbacks.get(ord('%'), default_callback)
@@ -615,9 +622,7 @@ class Editor():
             src_y = self.get_curr_window().buffer_cursor[1]
 
             pattern = self.registers['/']
-            results = self.get_curr_buffer().search_pattern(pattern)
-            if len(results) == 0: return False
-            pos = self._find_closest_match(src_x, src_y, results, self._search_forward)
+            pos = self.get_curr_buffer().search(pattern, src_x, src_y, self._search_forward)
             if not pos: return False
             dst_x, dst_y = pos[0], pos[1]
             scope = Scope(src_x, src_y, dst_x, dst_y)
@@ -630,9 +635,7 @@ class Editor():
             src_y = self.get_curr_window().buffer_cursor[1]
 
             pattern = self.registers['/']
-            results = self.get_curr_buffer().search_pattern(pattern)
-            if len(results) == 0: return False
-            pos = self._find_closest_match(src_x, src_y, results, not self._search_forward)
+            pos = self.get_curr_buffer().search(pattern, src_x, src_y, not self._search_forward)
             if not pos: return False
             dst_x, dst_y = pos[0], pos[1]
             scope = Scope(src_x, src_y, dst_x, dst_y)
@@ -1360,9 +1363,9 @@ class Editor():
             if data:
                 if data['meta'] == 'line':
                     lines = data['data']
-                    for line in reversed(lines):
-                        self.get_curr_window().insert_line_before(line, propagate=False)
-                    self.get_curr_buffer().flush_changes()
+                    with self.get_curr_buffer().batch():
+                        for line in reversed(lines):
+                            self.get_curr_window().insert_line_before(line, propagate=False)
                 elif data['meta'] == 'char':
                     lines = data['data']
                     string = '\n'.join(lines)
@@ -1518,9 +1521,9 @@ class Editor():
             if data:
                 if data['meta'] == 'line':
                     lines = data['data']
-                    for line in reversed(lines):
-                        self.get_curr_window().insert_line_before(line, propagate=False)
-                    self.get_curr_buffer().flush_changes()
+                    with self.get_curr_buffer().batch():
+                        for line in reversed(lines):
+                            self.get_curr_window().insert_line_before(line, propagate=False)
                 elif data['meta'] == 'char':
                     lines = data['data']
                     string = '\n'.join(lines)
@@ -1535,9 +1538,9 @@ class Editor():
             if data:
                 if data['meta'] == 'line':
                     lines = data['data']
-                    for line in lines:
-                        self.get_curr_window().insert_line_after(line, propagate=False)
-                    self.get_curr_buffer().flush_changes()
+                    with self.get_curr_buffer().batch():
+                        for line in lines:
+                            self.get_curr_window().insert_line_after(line, propagate=False)
                 elif data['meta'] == 'char':
                     lines = data['data']
                     _lines = []
@@ -1709,14 +1712,22 @@ class Editor():
             if len(pattern) == 0: return False
             pattern = pattern[0]
             pattern = r"((\W+)|(^))(?P<cword>"+pattern+r")\W"
-            results = self.get_curr_buffer().search_pattern(pattern)
-            if len(results) == 0: return False
-            start_x, start_y, end_x, end_y = results[0]
+            pos = self.get_curr_buffer().search(pattern, -1, 0)
+            if not pos: return False
+            start_x, start_y = pos
             self.get_curr_window().add_jump()
             self.get_curr_window().move_cursor_to_buf_location(start_x, start_y)
             self.get_curr_window().add_jump()
             return False
         self.maps[NORMAL][ord('g')][ord('d')] = gd_map
+        def g_minus_map(self):
+            self.get_curr_window().earlier()
+            return False
+        self.maps[NORMAL][ord('g')][ord('-')] = g_minus_map
+        def g_plus_map(self):
+            self.get_curr_window().later()
+            return False
+        self.maps[NORMAL][ord('g')][ord('+')] = g_plus_map
 
         def ctrl_t_map(self):
             gotovim(self)
@@ -2206,8 +2217,27 @@ class Editor():
         self.maps[INSERT][CTRL_X_KEY][ord('f')] = ctrl_xf_map
         self.maps[INSERT][CTRL_X_KEY][CTRL_F_KEY] = ctrl_xf_map
 
+    def _initialize_insert_arrow_maps(self):
+        def up_map(self):
+            self.get_curr_window().move_up()
+            return False
+        self.maps[INSERT][KEY_UP] = up_map
+        def down_map(self):
+            self.get_curr_window().move_down()
+            return False
+        self.maps[INSERT][KEY_DOWN] = down_map
+        def left_map(self):
+            self.get_curr_window().move_left()
+            return False
+        self.maps[INSERT][KEY_LEFT] = left_map
+        def right_map(self):
+            self.get_curr_window().move_right()
+            return False
+        self.maps[INSERT][KEY_RIGHT] = right_map
+
     def _initialize_insert_maps(self):
         self._initialize_insert_ctrl_maps()
+        self._initialize_insert_arrow_maps()
 
     def _initialize_visual_block_maps(self):
         pass
@@ -2464,9 +2494,9 @@ class Editor():
                 lines.append(self.get_curr_buffer().lines[y])
 
             self.change_begin()
-            for y in reversed(range(scope.start.y, scope.end.y + 1)):
-                self.get_curr_window().remove_line_at(y, propagate=False)
-            self.get_curr_buffer().flush_changes()
+            with self.get_curr_buffer().batch():
+                for y in reversed(range(scope.start.y, scope.end.y + 1)):
+                    self.get_curr_window().remove_line_at(y, propagate=False)
 
             self.change_end()
 
@@ -2490,9 +2520,9 @@ class Editor():
                 lines.append(self.get_curr_buffer().lines[y])
 
             self.change_begin()
-            for y in reversed(range(scope.start.y, scope.end.y)):
-                self.get_curr_window().remove_line_at(y, propagate=False)
-            self.get_curr_buffer().flush_changes()
+            with self.get_curr_buffer().batch():
+                for y in reversed(range(scope.start.y, scope.end.y)):
+                    self.get_curr_window().remove_line_at(y, propagate=False)
             self.get_curr_window().empty_line(keep_whitespaces=True)
 
             data = {}
@@ -2533,9 +2563,9 @@ class Editor():
 
             self.change_begin()
             # remove current lines
-            for y in reversed(range(scope.start.y, scope.end.y + 1)):
-                self.get_curr_window().remove_line_at(y, propagate=False)
-            self.get_curr_buffer().flush_changes()
+            with self.get_curr_buffer().batch():
+                for y in reversed(range(scope.start.y, scope.end.y + 1)):
+                    self.get_curr_window().remove_line_at(y, propagate=False)
 
             self.get_curr_window().move_up()
 
@@ -2544,9 +2574,9 @@ class Editor():
             if data:
                 if data['meta'] == 'line':
                     lines = data['data']
-                    for line in lines:
-                        self.get_curr_window().insert_line_after(line, propagate=False)
-                    self.get_curr_buffer().flush_changes()
+                    with self.get_curr_buffer().batch():
+                        for line in lines:
+                            self.get_curr_window().insert_line_after(line, propagate=False)
                 elif data['meta'] == 'char':
                     lines = data['data']
                     _lines = []
@@ -2716,9 +2746,9 @@ class Editor():
             if data:
                 if data['meta'] == 'line':
                     lines = data['data']
-                    for line in reversed(lines):
-                        self.get_curr_window().insert_line_before(line, propagate=False)
-                    self.get_curr_buffer().flush_changes()
+                    with self.get_curr_buffer().batch():
+                        for line in reversed(lines):
+                            self.get_curr_window().insert_line_before(line, propagate=False)
                 elif data['meta'] == 'char':
                     lines = data['data']
                     _lines = []
@@ -3004,11 +3034,13 @@ class Editor():
 
     def bootstrap(self):
         global args
-        global pending_buffer
 
         if not args.filename:
-            buffer = Buffer(data_in_bytes=pending_buffer)
+            buffer = Buffer()
             self._create_tab(buffer)
+            # piped input keeps coming in while we run
+            if not sys.stdin.isatty():
+                Stream(buffer, sys.stdin.fileno()).start()
         else:
             file = args.filename[0]
 
@@ -3108,6 +3140,7 @@ class Editor():
         except: pass
         return False
 
+    @overlay
     def draw_command(self, command):
         style = {}
         style['background'] = get_setting('status_line_background')
@@ -3184,6 +3217,16 @@ class Editor():
         self.get_curr_tab().draw()
         return False
 
+    def on_paste(self, text):
+        """ a bracketed paste goes in as a single insert, one change """
+        if self.mode in (INSERT, REPLACE):
+            self.get_curr_window().insert_string(text, keep_indent=False)
+        elif self.mode == NORMAL:
+            self.change_begin()
+            self.get_curr_window().insert_string(text, keep_indent=False)
+            self.change_end()
+        return False
+
     def on_insert(self, key):
         ret = False
 
@@ -3213,27 +3256,8 @@ class Editor():
             elog(f"traceback: {traceback.format_exc()}", type="ERROR")
         return ret
 
-    def _find_closest_match(self, x, y, matches, forward=True):
-        if forward:
-            for scope in matches:
-                if scope.start.y < y: continue
-                if scope.start.y == y and scope.start.x <= x: continue
-                return (scope.start.x, scope.start.y)
-            # wrap to start
-            return matches[0].start.x, matches[0].start.y
-        else:
-            for scope in reversed(matches):
-                if scope.start.y > y: continue
-                if scope.start.y == y and scope.start.x >= x: continue
-                return (scope.start.x, scope.start.y)
-            # wrap to end
-            return matches[-1].start.x, matches[-1].start.y
-
     def _on_search(self, x, y, pattern, forward, add_to_jumplist=False):
-        results = self.get_curr_buffer().search_pattern(pattern)
-        if len(results) == 0: return False
-
-        pos = self._find_closest_match(x, y, results, forward)
+        pos = self.get_curr_buffer().search(pattern, x, y, forward)
         if not pos: return False
 
         if add_to_jumplist: self.get_curr_window().add_jump()
@@ -3262,6 +3286,10 @@ class Editor():
                 to_return = text
                 break
             if key == ESC_KEY: break
+            if key == KEY_PASTE:
+                text += ''.join(c for c in self.screen.paste if c.isprintable())
+                if on_change: on_change(text)
+                continue
             if key == BACKSPACE_KEY:
                 if len(text) > 0:
                     text = text[:-1]
@@ -3314,6 +3342,10 @@ class Editor():
         if self.mode == NORMAL and self.curr_maps == self.maps[self.mode]:
             self.internal_registers["."] = [key]
 
+        if key == KEY_PASTE:
+            self.curr_maps = self.maps[self.mode]
+            return self.on_paste(self.screen.paste)
+
         if key == ESC_KEY:
             if self.mode == MULTI_CURSOR_INSERT:
                 self.change_mode(MULTI_CURSOR_NORMAL)
@@ -3410,21 +3442,6 @@ class Editor():
             elog(f"traceback: {traceback.format_exc()}", type="ERROR")
         return None
 
-def stdin_pending():
-    import termios
-    import fcntl
-    import array
-    import os
-
-    global pending_buffer
-
-    stdin = 0
-    size = array.array('i', [0])
-    fcntl.ioctl(stdin, termios.FIONREAD, size)
-    size = size[0]
-    if size > 0:
-        pending_buffer = os.read(stdin, size)
-
 def main():
     global args
 
@@ -3433,7 +3450,6 @@ def main():
     args = parser.parse_args()
 
     try:
-        stdin_pending()
         screen = Screen()
         editor = Editor(screen)
         editor.bootstrap()
@@ -3442,6 +3458,8 @@ def main():
         elog(f"traceback: {traceback.format_exc()}", type="ERROR")
         return
 
+    # from now on windows are drawn once the keys typed so far are handled
+    defer()
     k = 0
     while True:
         try:
@@ -3457,7 +3475,7 @@ def main():
             error.pop()
             editor.get_curr_tab().draw() # need to redraw after popup
 
-        k = screen.get_key()
+        k = screen.get_key(dispatch=True)
 
     screen.clear()
     screen.move_cursor(0,0)
@@ -15,6 +15,9 @@ ON_DRAW_TAB = "on_draw_tab"
 # Per Buffer
 ON_BUFFER_CHANGE = "on_buffer_change"
 ON_BUFFER_RELOAD = "on_buffer_reload"
+ON_BUFFER_SYNTAX = "on_buffer_syntax"
+ON_BUFFER_MATCH_COUNT = "on_buffer_match_count"
+ON_BUFFER_LINES_DROPPED = "on_buffer_lines_dropped"
 
 # Per Window
 ON_WINDOW_MOVE_UP_BEFORE = "on_window_move_up_before"
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+from functools import lru_cache
+from bisect import bisect_right
+import time
+import re
+
+from .task import Task, post
+
+
+# lines joined and searched at once when looking for the next match.
+SEARCH_CHUNK = 4096
+# seconds between the progress reports of a background count.
+COUNT_PROGRESS_INTERVAL = 0.1
+
+
+@lru_cache(maxsize=64)
+def compile_pattern(pattern, flags=0):
+    """ the compiled pattern, None if it is not a valid regex """
+    try: return re.compile(pattern, flags)
+    except re.error: return None
+
+def line_matches(regex, line):
+    """
+    ((start_x, end_x), ...) of the matches of regex in line, the span of the
+    last matched group when the pattern has groups.
+    """
+    spans = []
+    for m in regex.finditer(line):
+        spans.append(m.span(m.lastindex) if m.lastindex else m.span())
+    return tuple(spans)
+
+def _candidate_lines(lines, regex, start_y, end_y):
+    """
+    the lines in range(start_y, end_y, step) that regex matches, in that
+    order. Lines are first joined in chunks and searched as one text, so a
+    run of lines without a match costs a single regex search.
+    """
+    step = 1 if end_y >= start_y else -1
+    # \A and \Z mean the start and end of every line when matching by line
+    chunk_regex = None
+    if '\\A' not in regex.pattern and '\\Z' not in regex.pattern:
+        chunk_regex = compile_pattern(regex.pattern, regex.flags | re.MULTILINE)
+
+    for chunk_y in range(start_y, end_y, step * SEARCH_CHUNK):
+        chunk_end_y = chunk_y + step * SEARCH_CHUNK
+        chunk_end_y = min(chunk_end_y, end_y) if step > 0 else max(chunk_end_y, end_y)
+        if step > 0: chunk = lines[chunk_y:chunk_end_y]
+        else: chunk = lines[chunk_end_y + 1:chunk_y + 1][::-1]
+
+        if chunk_regex and not chunk_regex.search(''.join(chunk)): continue
+        for i, line in enumerate(chunk):
+            if regex.search(line): yield chunk_y + step * i
+
+def iter_matches(lines, pattern, x, y, forward=True):
+    """
+    (x, y) of the matches of pattern after (before) (x, y), in search order,
+    going around the end (start) of the buffer once. Lines are matched as
+    the search reaches them, so the nearest match comes right away.
+    """
+    regex = compile_pattern(pattern)
+    if not regex or len(lines) == 0: return
+    y = max(0, min(y, len(lines) - 1))
+
+    if forward: ranges = [(y, len(lines)), (0, y + 1)]
+    else: ranges = [(y, -1), (len(lines) - 1, y - 1)]
+
+    for wrapped, (start_y, end_y) in enumerate(ranges):
+        for curr_y in _candidate_lines(lines, regex, start_y, end_y):
+            matches = line_matches(regex, lines[curr_y])
+            if not forward: matches = reversed(matches)
+            for start_x, end_x in matches:
+                if curr_y == y:
+                    after = start_x > x if forward else start_x < x
+                    # past the cursor on the way, before it once wrapped
+                    if after == bool(wrapped): continue
+                yield (start_x, curr_y)
+
+
+class Highlight():
+    """
+    The matches of a pattern in a buffer, by line. Lines are matched the
+    first time they are asked for and kept until a change touches them, a
+    change that adds or removes lines shifts the matches after it.
+    """
+    def __init__(self, pattern, style):
+        self.pattern = pattern
+        self.regex = compile_pattern(pattern)
+        self.style = style
+        self._lines = None # per line matches, None for a line not matched yet
+
+    def _sync(self, lines):
+        if self._lines is None or len(self._lines) != len(lines):
+            self._lines = [None] * len(lines)
+
+    def get(self, lines, y):
+        """ matches of line y """
+        if not self.regex: return ()
+        self._sync(lines)
+        matches = self._lines[y]
+        if matches is None:
+            matches = self._lines[y] = line_matches(self.regex, lines[y])
+        return matches
+
+    def on_change(self, change):
+        if self._lines is None: return
+        if not change or "all" in change:
+            self._lines = None
+            return
+
+        start_y = change['start_point'][0]
+        old_end_y = change['old_end_point'][0]
+        new_end_y = change['new_end_point'][0]
+        self._lines[start_y:old_end_y + 1] = [None] * (new_end_y - start_y + 1)
+
+    def index_in_line(self, lines, x, y):
+        """ 0 based index of the match under (x, y) in line y, None if there is none """
+        matches = self.get(lines, y)
+        i = bisect_right(matches, (x, float('inf'))) - 1
+        # a match ending where the next starts comes first
+        if i > 0 and matches[i - 1][1] >= x: i -= 1
+        if i < 0 or not matches[i][0] <= x <= matches[i][1]: return None
+        return i
+
+
+class MatchCount():
+    """
+    The number of matches of a pattern in a version of the buffer, counted
+    in chunks of lines on a background task over a snapshot of the lines.
+    Counting stops once more than budget matches are found, the total is then
+    only a lower bound. on_progress is called on the main thread as the
+    count goes and once it is done.
+    """
+    def __init__(self, pattern, version, budget):
+        self.pattern = pattern
+        self.version = version
+        self.budget = budget
+        self.total = 0
+        self.done = False
+        self.exceeded = False
+        self._before = [0] # number of matches before every counted chunk
+        self._cancelled = False
+
+    def start(self, lines, on_progress):
+        regex = compile_pattern(self.pattern)
+        if not regex or len(lines) == 0:
+            self.done = True
+            return
+
+        def count_chunk(chunk_y):
+            chunk_end_y = min(chunk_y + SEARCH_CHUNK, len(lines))
+            return sum(len(line_matches(regex, lines[y]))
+                       for y in _candidate_lines(lines, regex, chunk_y, chunk_end_y))
+
+        # a single chunk is counted right away, no need for a task
+        if len(lines) <= SEARCH_CHUNK:
+            self._add_chunk(count_chunk(0))
+            self.done = True
+            return
+
+        def count(_):
+            reported = time.monotonic()
+            total = 0
+            for chunk_y in range(0, len(lines), SEARCH_CHUNK):
+                if self._cancelled: return
+                found = count_chunk(chunk_y)
+                total += found
+                post(self._add_chunk, found)
+                if total > self.budget: break
+
+                if time.monotonic() - reported > COUNT_PROGRESS_INTERVAL:
+                    reported = time.monotonic()
+                    post(on_progress, self)
+                time.sleep(0) # let the main thread handle keys
+            post(self._finish, on_progress)
+
+        Task(count, None).start()
+
+    def _add_chunk(self, found):
+        self.total += found
+        self._before.append(self.total)
+        if self.total > self.budget: self.exceeded = True
+
+    def _finish(self, on_progress):
+        if self._cancelled: return
+        self.done = True
+        on_progress(self)
+
+    def cancel(self): self._cancelled = True
+
+    def index_of(self, highlight, lines, x, y):
+        """
+        1 based index of the match under (x, y), None if there is none or
+        its chunk is not counted yet.
+        """
+        chunk = y // SEARCH_CHUNK
+        if chunk >= len(self._before) - 1 or not highlight.regex: return None
+        i = highlight.index_in_line(lines, x, y)
+        if i is None: return None
+
+        chunk_y = chunk * SEARCH_CHUNK
+        before = sum(len(highlight.get(lines, curr_y))
+                     for curr_y in _candidate_lines(lines, highlight.regex, chunk_y, y))
+        return self._before[chunk] + before + i + 1
+
+    def status(self):
+        """ the total for the status line, > while it is a lower bound """
+        if self.exceeded: return f">{self.budget}"
+        if not self.done: return f">{self.total}"
+        return str(self.total)
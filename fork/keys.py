@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+from codecs import getincrementaldecoder
+from collections import deque
+
+ESC = 0x1b
+
+# special keys, past the last code point so they never collide with a char.
+KEY_UP = 0x110000
+KEY_DOWN = 0x110001
+KEY_RIGHT = 0x110002
+KEY_LEFT = 0x110003
+KEY_HOME = 0x110004
+KEY_END = 0x110005
+KEY_INSERT = 0x110006
+KEY_DELETE = 0x110007
+KEY_PAGE_UP = 0x110008
+KEY_PAGE_DOWN = 0x110009
+KEY_F1 = 0x110010 # KEY_F1 + n - 1 is Fn
+KEY_PASTE = 0x110020 # its text is in KeyDecoder.pastes
+
+# bracketed paste, the terminal wraps pasted text with these.
+PASTE_START = b'\x1b[200~'
+PASTE_END = b'\x1b[201~'
+
+# final byte of a CSI (ESC [) or SS3 (ESC O) sequence: key
+FINAL_KEYS = {
+    ord('A'): KEY_UP,
+    ord('B'): KEY_DOWN,
+    ord('C'): KEY_RIGHT,
+    ord('D'): KEY_LEFT,
+    ord('H'): KEY_HOME,
+    ord('F'): KEY_END,
+    ord('P'): KEY_F1,
+    ord('Q'): KEY_F1 + 1,
+    ord('R'): KEY_F1 + 2,
+    ord('S'): KEY_F1 + 3,
+}
+
+# first parameter of a CSI sequence ending with ~: key
+TILDE_KEYS = {
+    1: KEY_HOME,
+    2: KEY_INSERT,
+    3: KEY_DELETE,
+    4: KEY_END,
+    5: KEY_PAGE_UP,
+    6: KEY_PAGE_DOWN,
+    7: KEY_HOME,
+    8: KEY_END,
+    11: KEY_F1,
+    12: KEY_F1 + 1,
+    13: KEY_F1 + 2,
+    14: KEY_F1 + 3,
+    15: KEY_F1 + 4,
+    17: KEY_F1 + 5,
+    18: KEY_F1 + 6,
+    19: KEY_F1 + 7,
+    20: KEY_F1 + 8,
+    21: KEY_F1 + 9,
+    23: KEY_F1 + 10,
+    24: KEY_F1 + 11,
+}
+
+# longest CSI sequence we wait for, anything longer is not one.
+MAX_SEQUENCE = 32
+
+
+def _csi_key(params, final):
+    """ key of the CSI sequence, None for one we do not know """
+    if final == ord('~'):
+        first = params.split(b';')[0]
+        return TILDE_KEYS.get(int(first)) if first.isdigit() else None
+    # modifiers (ESC [ 1 ; 5 A) are dropped
+    return FINAL_KEYS.get(final)
+
+def _parse_escape(data, i):
+    """
+    (key, end) of the escape at data[i], key is None for a sequence that is
+    dropped, end is None when data ends before the sequence does.
+    """
+    if i + 1 == len(data): return None, None
+    introducer = data[i + 1]
+
+    if introducer == ord('['):
+        j = i + 2
+        while j < len(data) and 0x20 <= data[j] <= 0x3f: j += 1
+        if j == len(data):
+            if j - i < MAX_SEQUENCE: return None, None
+            return ESC, i + 1
+        if not 0x40 <= data[j] <= 0x7e: return ESC, i + 1
+        return _csi_key(data[i + 2:j], data[j]), j + 1
+
+    if introducer == ord('O'):
+        if i + 2 == len(data): return None, None
+        key = FINAL_KEYS.get(data[i + 2])
+        if key: return key, i + 3
+
+    # a lone escape, what follows is decoded on its own
+    return ESC, i + 1
+
+
+class KeyDecoder():
+    """
+    Turns the bytes read from the terminal into keys: the code point of
+    every char, and a KEY_* for the CSI and SS3 sequences of special keys.
+    An escape at the end of the input may be the start of a sequence, it is
+    held until more input comes or flush() gives up waiting for it. A
+    bracketed paste is a single KEY_PASTE, its text is queued in pastes.
+    """
+    def __init__(self):
+        self._pending = b''
+        self._chars = getincrementaldecoder('utf-8')(errors='replace')
+        self._paste = None # bytes of the paste being read
+        self.pastes = deque()
+
+    def pending(self):
+        """ whether an escape is held, a paste waits for its end as long as it takes """
+        return self._paste is None and len(self._pending) > 0
+
+    def _read_paste(self, data, i):
+        """ index in data past the end of the paste, None if it goes on """
+        end = data.find(PASTE_END, i)
+        if end == -1:
+            # the end marker may be cut between reads
+            keep = len(PASTE_END) - 1
+            self._paste += data[i:len(data) - keep]
+            self._pending = data[max(i, len(data) - keep):]
+            return None
+
+        self._paste += data[i:end]
+        text = self._paste.decode('utf-8', errors='replace')
+        self.pastes.append(text.replace('\r\n', '\n').replace('\r', '\n'))
+        self._paste = None
+        return end + len(PASTE_END)
+
+    def feed(self, data):
+        """ keys of data, along with the input held from before """
+        data = self._pending + data
+        self._pending = b''
+        keys = []
+        i = 0
+        while i < len(data):
+            if self._paste is not None:
+                i = self._read_paste(data, i)
+                if i is None: break
+                keys.append(KEY_PASTE)
+                continue
+
+            if data.startswith(PASTE_START, i):
+                self._paste = b''
+                i += len(PASTE_START)
+                continue
+
+            if data[i] != ESC:
+                j = data.find(ESC, i)
+                if j == -1: j = len(data)
+                keys.extend(map(ord, self._chars.decode(data[i:j])))
+                i = j
+                continue
+
+            key, end = _parse_escape(data, i)
+            if end is None:
+                self._pending = data[i:]
+                break
+            if key is not None: keys.append(key)
+            i = end
+        return keys
+
+    def flush(self):
+        """ keys of the held input, taking its escape as a key of its own """
+        data = self._pending
+        self._pending = b''
+        if not data: return []
+        return [ESC] + self.feed(data[1:])
@@ -28,6 +28,7 @@ def gotovim(editor):
                   stdout=stdout,
                   env=env)
         output, errors = p.communicate()
+        editor.screen.invalidate()
     except Exception as e:
             elog(f"Exception: {e}", type="ERROR")
             elog(f"traceback: {traceback.format_exc()}", type="ERROR")
@@ -65,6 +66,7 @@ def rg_fzf(editor, pattern):
                   stderr=stderr,
                   env=env)
         output, errors = p.communicate()
+        editor.screen.invalidate()
         file_path = output.decode('utf-8').strip()
         file_path = file_path.replace("\n", "")
         if len(file_path) > 0: return file_path
@@ -102,6 +104,7 @@ def fzf(editor):
                   stderr=stderr,
                   env=env)
         output, errors = p.communicate()
+        editor.screen.invalidate()
         file_path = output.decode('utf-8').strip()
         file_path = file_path.replace("\n", "")
         if len(file_path) > 0: return file_path
@@ -170,29 +173,29 @@ def comment(editor, start_y, end_y):
             commented = False
             break
 
-    if not commented:
-        # lets comment
-        for y in range(start_y, end_y + 1):
-            line = editor.get_curr_window().get_line(y)
-            if re.match(r'^\s*$', line): continue # skip empty lines
-            i = _index_of_first_nonspace_char(line)
-            if i == -1:
-                elog(f"i: {i} {line}")
-                continue
-            line = f"{line[:i]}{comment_syntax} {line[i:]}"
-            editor.get_curr_window().set_line(y, line, propagate=False)
-    else:
-        # lets uncomment
-        for y in range(start_y, end_y + 1):
-            line = editor.get_curr_window().get_line(y)
-            if re.match(r'^\s*$', line): continue # skip empty lines
-            i = _index_of_first_nonspace_char(line)
-            if i == -1:
-                elog(f"i: {i} {line}")
-                continue
-            line = f"{line[:i]}{line[i+len(comment_syntax)+1:]}"
-            editor.get_curr_window().set_line(y, line, propagate=False)
-    editor.get_curr_buffer().flush_changes()
+    with editor.get_curr_buffer().batch():
+        if not commented:
+            # lets comment
+            for y in range(start_y, end_y + 1):
+                line = editor.get_curr_window().get_line(y)
+                if re.match(r'^\s*$', line): continue # skip empty lines
+                i = _index_of_first_nonspace_char(line)
+                if i == -1:
+                    elog(f"i: {i} {line}")
+                    continue
+                line = f"{line[:i]}{comment_syntax} {line[i:]}"
+                editor.get_curr_window().set_line(y, line, propagate=False)
+        else:
+            # lets uncomment
+            for y in range(start_y, end_y + 1):
+                line = editor.get_curr_window().get_line(y)
+                if re.match(r'^\s*$', line): continue # skip empty lines
+                i = _index_of_first_nonspace_char(line)
+                if i == -1:
+                    elog(f"i: {i} {line}")
+                    continue
+                line = f"{line[:i]}{line[i+len(comment_syntax)+1:]}"
+                editor.get_curr_window().set_line(y, line, propagate=False)
 
 def paste_from_clipboard():
     ''' Paste `text` from the clipboard '''
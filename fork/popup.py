@@ -2,6 +2,7 @@ from .treesitter import traverse_tree
 from .settings import *
 from .log import elog
 from .screen import *
+from .render import overlay
 
 from difflib import SequenceMatcher as SM
 from os import path
@@ -124,6 +125,8 @@ class Popup():
                                 to_flush=False)
         except Exception as e: print(f"Exception: {e}")
 
+    @overlay
+    @single_frame
     def draw(self):
         try:
             style = {}
@@ -218,6 +221,8 @@ class DetailsPopup():
         self.screen.get_key()
         self.screen.enable_cursor()
 
+    @overlay
+    @single_frame
     def draw(self):
         try:
             style = {}
@@ -377,6 +382,8 @@ class CompletionPopup():
         self.screen.enable_cursor()
         return self.ret
 
+    @overlay
+    @single_frame
     def draw(self):
         try:
             style = {}
@@ -718,6 +725,8 @@ class TreeSitterPopup():
         self.screen.enable_cursor()
         return self.ret_node
 
+    @overlay
+    @single_frame
     def draw(self):
         try:
             style = {}
@@ -1016,6 +1025,8 @@ class LinesPopup():
         self.screen.enable_cursor()
         return self.y_ret
 
+    @overlay
+    @single_frame
     def draw(self):
         try:
             style = {}
@@ -1102,6 +1113,8 @@ class ErrorPopup():
         self.screen.get_key()
         self.screen.enable_cursor()
 
+    @overlay
+    @single_frame
     def draw(self):
         try:
             style = {}
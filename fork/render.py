@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+import time
+
+from .settings import get_setting
+from .log import elog
+
+# object: draw method of the draws asked for since the last render, in the
+# order they were asked for.
+g_pending = {}
+g_deferred = False
+g_rendering = False
+g_last_render = 0
+# screen.cursor_moves when the last draw was asked for
+g_cursor_moves = 0
+
+g_requested = 0
+g_performed = 0
+
+def defer(enabled=True):
+    """ from now on a draw only marks what is to be drawn, render() draws it """
+    global g_deferred
+    g_deferred = enabled
+
+def scheduled(func):
+    """
+    draw method decorator. While draws are deferred, a call marks self to be
+    drawn by the next render(), a pending draw of its tab covers it.
+    Otherwise, and while rendering, it draws right away.
+    """
+    def wrapper(self, *args, **kwargs):
+        global g_requested, g_performed, g_cursor_moves
+        g_requested += 1
+        if not g_deferred or g_rendering:
+            g_performed += 1
+            return func(self, *args, **kwargs)
+
+        if getattr(self, 'tab', None) in g_pending: return
+        for pending in [p for p in g_pending if p is self or getattr(p, 'tab', None) is self]:
+            del g_pending[pending]
+        g_pending[self] = func
+        g_cursor_moves = self.screen.cursor_moves
+    return wrapper
+
+def overlay(func):
+    """ draw method decorator of what is drawn over the windows, after their pending draws """
+    def wrapper(self, *args, **kwargs):
+        render(self.screen, force=True)
+        return func(self, *args, **kwargs)
+    return wrapper
+
+def render_timeout():
+    """ seconds until the pending draws may be rendered, None without any """
+    if not g_pending: return None
+    fps = get_setting('max_fps')
+    if not fps: return 0
+    return max(0, g_last_render + 1 / fps - time.monotonic())
+
+def render(screen, force=False):
+    """
+    make the pending draws in a single frame, unless max_fps says it is too
+    early for another one. The cursor stays where it was moved to after the
+    draws were asked for.
+    """
+    global g_rendering, g_last_render, g_performed
+    if not g_pending: return
+    if not force and render_timeout() > 0: return
+
+    pending = list(g_pending.items())
+    g_pending.clear()
+    cursor = screen.get_cursor() if screen.cursor_moves != g_cursor_moves else None
+
+    g_rendering = True
+    try:
+        with screen.frame():
+            for target, func in pending:
+                g_performed += 1
+                try: func(target)
+                except Exception as e: elog(f"draw failed: {e}", type="ERROR")
+            if cursor: screen.move_cursor(*cursor, to_flush=False)
+    finally:
+        g_rendering = False
+        g_last_render = time.monotonic()
+
+def stats():
+    """ (requested, performed) draws so far """
+    return g_requested, g_performed
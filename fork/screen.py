@@ -7,13 +7,22 @@ from .settings import *
 from .log import elog
 from .events import *
 from .hooks import *
+from .task import wake_fd, run_posted, timers_timeout, run_timers
+from .render import render, render_timeout
+from .style import convert
+from .keys import *
 
 from signal import signal, SIGWINCH
+from selectors import DefaultSelector, EVENT_READ
+from collections import deque
+from contextlib import contextmanager
+import time
 
 from termios import tcgetattr, tcsetattr, TCSADRAIN
 from tty import setraw
 import sys
 import os
+from unicodedata import east_asian_width, combining
 
 
 BACKGROUND_TRUE_COLOR = "\x1b[48;2;{}m"
@@ -30,6 +39,9 @@ NO_ECHO = "\x1b[8m"
 WRAP = "\x1b[?7h"
 NO_WRAP = "\x1b[?7l"
 
+BRACKETED_PASTE = "\x1b[?2004h"
+NO_BRACKETED_PASTE = "\x1b[?2004l"
+
 CURSOR_DISABLE = "\x1b[?25l"
 CURSOR_ENABLE = "\x1b[?25h"
 CURSOR_I_BEAM = "\x1b[6 q"
@@ -47,6 +59,7 @@ SAVE_CURSOR = "\x1b[s"
 RESTORE_CURSOR = "\x1b[u"
 
 CLEAR_LINE = "\x1b[2K"
+CLEAR_EOL = "\x1b[K"
 CLEAR = "\x1b[2J"
 
 CTRL_D_KEY = 4
@@ -79,9 +92,16 @@ PGUP_KEY = 10
 
 from functools import lru_cache
 @lru_cache(None)
-def convert(a):
-    r, g, b = int(a[1:3], 16), int(a[3:5], 16), int(a[5:7], 16)
-    return f"{r};{g};{b}"
+def char_width(char):
+    """ how many terminal columns a character takes """
+    if combining(char): return 0
+    return 2 if east_asian_width(char) in 'WF' else 1
+
+def _narrow(chars):
+    """ whether every cell of a row takes exactly one terminal column """
+    if chars[0] is None: return True
+    text = ''.join(chars)
+    return text.isascii() or all(char_width(c) == 1 for c in text)
 
 def get_terminal_size():
     import os
@@ -115,10 +135,32 @@ def get_terminal_size():
         #    cr = (25, 80)
     return int(cr[1]), int(cr[0])
 
+def single_frame(func):
+    """ method decorator, whatever func draws on self.screen is presented at once """
+    def wrapper(self, *args, **kwargs):
+        with self.screen.frame():
+            return func(self, *args, **kwargs)
+    return wrapper
+
 class Screen():
+    """
+    Drawing goes to a back grid of cells (char + Style), present()
+    compares it with the front grid, what the terminal shows, and writes only
+    the cells that differ in a single write.
+    """
     def screen_resize_handler(self, signum, frame):
+        # handled by the input loop, not in the middle of what runs now
+        try: os.write(self._resize_write, b'\0')
+        except BlockingIOError: pass
+
+    def _on_resize(self):
+        try:
+            while os.read(self._resize_read, 4096): pass
+        except BlockingIOError: pass
+
         size = get_terminal_size()
         self.width, self.height = size
+        self._reset_grids()
         Hooks.execute(ON_RESIZE, size)
 
     def __init__(self):
@@ -140,10 +182,33 @@ class Screen():
         size = get_terminal_size()
         self.width, self.height = size
 
+        self._out = [] # escapes waiting for the next present()
+        self._frames = 0 # open frame() blocks
+        self._cursor = (0, 0)
+        self._cursor_moved = False
+        self.cursor_moves = 0 # move_cursor() calls so far
+        self._cursor_visible = True
+        self._reset_grids()
+
+        self._resize_read, self._resize_write = os.pipe()
+        os.set_blocking(self._resize_read, False)
+        os.set_blocking(self._resize_write, False)
         signal(SIGWINCH, self.screen_resize_handler)
         self._disable_wrap()
+        self._write_to_stdout(BRACKETED_PASTE)
 
         self.queue = []
+        self.decoder = KeyDecoder()
+        self._keys = deque() # decoded, not handled yet
+        self.paste = '' # text of the last KEY_PASTE
+        self._esc_deadline = None # when a held escape is taken as a key
+        # keys and resizes wake both up, posted callbacks only the second
+        self._key_selector = DefaultSelector()
+        self._dispatch_selector = DefaultSelector()
+        for selector in (self._key_selector, self._dispatch_selector):
+            selector.register(self.stdin.fileno(), EVENT_READ)
+            selector.register(self._resize_read, EVENT_READ)
+        self._dispatch_selector.register(wake_fd(), EVENT_READ)
 
         self.old_stdin_settings = tcgetattr(self.stdin)
         r = setraw(self.stdin.fileno())
@@ -152,22 +217,144 @@ class Screen():
         tcsetattr(  self.stdin,
                     TCSADRAIN,
                     self.old_stdin_settings)
+        self._write_to_stdout(NO_BRACKETED_PASTE, to_flush=False)
         self._enable_wrap()
 
     def _write_to_stdout(self, to_write, to_flush=True):
-        # os.write(self.stdout, to_write.encode())
-        self.stdout.write(to_write)
+        self._out.append(to_write)
         if to_flush: self.flush()
 
+    def _reset_grids(self):
+        """ new grids for the current size, the next present() repaints all """
+        blank = get_style(None)
+        self._back_chars = [[' '] * self.width for _ in range(self.height)]
+        self._back_styles = [[blank] * self.width for _ in range(self.height)]
+        self.invalidate()
+
+    def invalidate(self):
+        """ the terminal was drawn over by someone else, the next present() repaints all """
+        self._front_chars = [[None] * self.width for _ in range(self.height)]
+        self._front_styles = [[None] * self.width for _ in range(self.height)]
+        self._dirty = set(range(self.height))
+
+    def present(self):
+        """ write everything that changed since the last present, at once """
+        out = self._out
+        self._out = []
+
+        cells = []
+        curr_style = None
+        for y in sorted(self._dirty):
+            if y >= len(self._back_chars): continue
+            back_chars = self._back_chars[y]
+            back_styles = self._back_styles[y]
+            front_chars = self._front_chars[y]
+            front_styles = self._front_styles[y]
+            if back_chars == front_chars and back_styles == front_styles: continue
+
+            # the terminal does not put a wide character in a single cell, the
+            # cells after it are not where the grid has them: the whole row
+            # is written from the start for the terminal to lay out.
+            if not _narrow(back_chars) or not _narrow(front_chars):
+                cells.append(MOVE.format(y + 1, 1))
+                for char, style in zip(back_chars, back_styles):
+                    if style is not curr_style:
+                        cells.append(style.sgr)
+                        curr_style = style
+                    cells.append(char)
+                if sum(map(char_width, back_chars)) < self.width: cells.append(CLEAR_EOL)
+                front_chars[:] = back_chars
+                front_styles[:] = back_styles
+                continue
+
+            next_x = -1 # where the terminal cursor is after the last cell
+            for x in range(min(len(back_chars), len(front_chars))):
+                char = back_chars[x]
+                style = back_styles[x]
+                if char == front_chars[x] and style is front_styles[x]: continue
+
+                if x != next_x: cells.append(MOVE.format(y + 1, x + 1))
+                # styles are interned, an unchanged style is not re-emitted
+                if style is not curr_style:
+                    cells.append(style.sgr)
+                    curr_style = style
+                cells.append(char)
+                next_x = x + 1
+
+            front_chars[:] = back_chars
+            front_styles[:] = back_styles
+        self._dirty.clear()
+
+        if cells or self._cursor_moved:
+            if cells and self._cursor_visible: out.append(CURSOR_DISABLE)
+            out.extend(cells)
+            out.append(MOVE.format(self._cursor[0] + 1, self._cursor[1] + 1))
+            if cells and self._cursor_visible: out.append(CURSOR_ENABLE)
+            self._cursor_moved = False
+
+        if len(out) == 0: return
+        data = memoryview(''.join(out).encode())
+        fd = self.stdout.fileno()
+        while len(data) > 0:
+            data = data[os.write(fd, data):]
+
+    @contextmanager
+    def frame(self):
+        """
+        Flushes inside the frame are deferred, what was drawn is presented
+        once, when the outermost frame ends.
+        """
+        self._frames += 1
+        try: yield self
+        finally:
+            self._frames -= 1
+            if self._frames == 0: self.present()
+
     def set_keys(self, keys):
         self.queue.extend(reversed(keys))
 
-    def get_key(self):
+    def _read_keys(self, dispatch):
+        """
+        Block until keys are typed. Whatever there is to read is read at once
+        and decoded, an escape they end with waits esc_timeout ms for the
+        rest of its sequence. With dispatch, the callbacks posted by worker
+        threads and the due timers are run while waiting. The pending draws
+        are rendered before waiting.
+        """
+        fd = self.stdin.fileno()
+        selector = self._dispatch_selector if dispatch else self._key_selector
+        while not self._keys:
+            render(self)
+            timeouts = []
+            if render_timeout() is not None: timeouts.append(render_timeout())
+            if self._esc_deadline: timeouts.append(max(0, self._esc_deadline - time.monotonic()))
+            if dispatch and timers_timeout() is not None: timeouts.append(timers_timeout())
+            ready = [key.fd for key, _ in selector.select(min(timeouts) if timeouts else None)]
+
+            if self._resize_read in ready: self._on_resize()
+            if dispatch:
+                if wake_fd() in ready: run_posted()
+                run_timers()
+
+            if fd in ready:
+                data = os.read(fd, 4096)
+                if not data: raise EOFError("stdin closed")
+                self._keys.extend(self.decoder.feed(data))
+            elif self._esc_deadline and time.monotonic() >= self._esc_deadline:
+                self._keys.extend(self.decoder.flush())
+
+            if not self.decoder.pending(): self._esc_deadline = None
+            elif not self._esc_deadline:
+                self._esc_deadline = time.monotonic() + get_setting('esc_timeout') / 1000
+
+    def get_key(self, dispatch=False):
         try:
             if len(self.queue) > 0:
                 k = self.queue.pop()
             else:
-                k = ord(self.stdin.read(1))
+                if not self._keys: self._read_keys(dispatch)
+                k = self._keys.popleft()
+                if k == KEY_PASTE: self.paste = self.decoder.pastes.popleft()
             # elog(f"key: {k}")
             Hooks.execute(ON_KEY, k)
             return k
@@ -200,19 +387,18 @@ class Screen():
         self._write_to_stdout(RESTORE_CURSOR, to_flush)
 
     def clear_line(self, y):
-        self._save_cursor(to_flush=False)
-
-        self.move_cursor(y, 0, to_flush=False)
-        self._write_to_stdout(CLEAR_LINE, to_flush=False)
-
-        self._restore_cursor(to_flush=False)
-        self.flush()
+        self.write(y, 0, " " * self.width)
 
     def clear_line_partial(self, y, start_x, end_x):
         empty = " " * (end_x - start_x)
         self.write(y, start_x, empty)
 
     def clear(self):
+        self._reset_grids()
+        # the terminal is blank now, so is the back grid.
+        self._front_chars = [row.copy() for row in self._back_chars]
+        self._front_styles = [row.copy() for row in self._back_styles]
+        self._dirty.clear()
         self._write_to_stdout(CLEAR)
 
     def set_cursor_i_beam(self):
@@ -225,41 +411,33 @@ class Screen():
         self._write_to_stdout(CURSOR_BLOCK_BLINK)
 
     def disable_cursor(self):
+        self._cursor_visible = False
         self._write_to_stdout(CURSOR_DISABLE)
     def enable_cursor(self):
+        self._cursor_visible = True
         self._write_to_stdout(CURSOR_ENABLE)
 
+    def get_cursor(self): return self._cursor
+
     def move_cursor(self, y, x, to_flush=True):
-        y += 1; x += 1
-        escape = MOVE.format(y, x)
-        self._write_to_stdout(escape, to_flush=to_flush)
-
-    def _set_style(self, style, to_flush=True):
-        if not style: style = {}
-        fg =    style['foreground'] if 'foreground' in style else  \
-                get_settings()['theme']['colors']['editor.foreground']
-        bg =    style['background'] if 'background' in style else  \
-                get_settings()['theme']['colors']['editor.background']
-
-        if fg: self._write_to_stdout(FOREGROUND_TRUE_COLOR.format(convert(fg)), to_flush=False)
-        if bg: self._write_to_stdout(BACKGROUND_TRUE_COLOR.format(convert(bg)), to_flush=False)
-
-        if 'reverse' in style:
-            self._write_to_stdout(REVERSE, to_flush=False)
+        self._cursor = (y, x)
+        self._cursor_moved = True
+        self.cursor_moves += 1
         if to_flush: self.flush()
 
     def flush(self):
-        self.stdout.flush()
-        # pass
+        if self._frames > 0: return
+        self.present()
 
     def write(self, y, x, string, style=None, to_flush=True):
-        self._save_cursor(to_flush=False)
-
-        self.move_cursor(y, x, to_flush=False)
-        self._set_style(style, to_flush=False)
-        self._write_to_stdout(string, to_flush=False)
-
-        self._restore_cursor(to_flush=False)
+        if 0 <= y < self.height and x < self.width:
+            if x < 0:
+                string = string[-x:]
+                x = 0
+            string = string[:self.width - x]
+            self._back_chars[y][x:x + len(string)] = string
+            self._back_styles[y][x:x + len(string)] = [get_style(style)] * len(string)
+            self._dirty.add(y)
         if to_flush: self.flush()
 
 
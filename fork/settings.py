@@ -2,6 +2,7 @@ from os import path
 import json
 
 from .colors import brighten_color
+from .style import Style
 from .log import elog
 
 
@@ -20,6 +21,8 @@ def optimize_theme():
     g_settings['theme_opt'] = {}
 
     theme = g_settings['theme']
+    g_settings['default_style'] = Style(theme['colors']['editor.foreground'],
+                                        theme['colors']['editor.background'])
 
     token_colors = theme['tokenColors']
     for token in token_colors:
@@ -27,11 +30,11 @@ def optimize_theme():
         if "scope" not in token: continue
         if isinstance(token['scope'], list):
             for s in token['scope']:
-                add_to_theme(s, token["settings"])
+                add_to_theme(s, get_style(token["settings"]))
         else:
             scopes = [x.strip() for x in token['scope'].split(',')]
             for s in scopes:
-                add_to_theme(s, token["settings"])
+                add_to_theme(s, get_style(token["settings"]))
 
 def load_settings():
     global g_settings
@@ -59,6 +62,18 @@ def get_settings():
     global g_settings
     return g_settings
 
+def get_style(style):
+    """
+    The interned Style of a style dict, colors it does not set are the
+    editor's default ones.
+    """
+    if isinstance(style, Style): return style
+    default = g_settings['default_style']
+    if not style: return default
+    return Style(style.get('foreground') or default.foreground,
+                 style.get('background') or default.background,
+                 'reverse' in style)
+
 def get_setting(key, default=None):
     if key == "line_numbers":
         _ = False if not default else default
@@ -97,6 +112,9 @@ def get_setting(key, default=None):
     if key == "search_highlights_foreground":
         _ = "#000000" if not default else default
         return get_settings().get(key, _)
+    if key == "search_count_budget":
+        _ = 10000 if not default else default
+        return get_settings().get(key, _)
 
     if key == "multi_cursors_background":
         _ = "#FFC000" if not default else default
@@ -131,6 +149,27 @@ def get_setting(key, default=None):
     if key == "syntax":
         _ = "sync" if not default else default
         return get_settings().get(key, _)
+    if key == "storage":
+        _ = "rope" if not default else default
+        return get_settings().get(key, _)
+    if key == "esc_timeout":
+        _ = 25 if not default else default
+        return get_settings().get(key, _)
+    if key == "max_fps":
+        _ = 0 if not default else default
+        return get_settings().get(key, _)
+    if key == "stdin_max_lines":
+        _ = 0 if not default else default
+        return get_settings().get(key, _)
+    if key == "large_file_size":
+        _ = 64 * 1024 * 1024 if not default else default
+        return get_settings().get(key, _)
+    if key == "undo_memory":
+        _ = 64 * 1024 * 1024 if not default else default
+        return get_settings().get(key, _)
+    if key == "undo_file":
+        _ = True if not default else default
+        return get_settings().get(key, _)
 
     return get_settings().get(key, default)
 
@@ -0,0 +1,428 @@
+#!/usr/bin/python3
+from .settings import get_setting
+
+from functools import lru_cache
+from itertools import accumulate
+from bisect import bisect_right
+import mmap
+
+# max number of lines a rope leaf holds before it is split in two.
+CHUNK_SIZE = 512
+# bytes of a mapped file in a leaf, cut at the next new line.
+MAP_BLOCK_SIZE = 1 << 20
+
+
+def byte_len(string):
+    """ length of string once encoded to utf-8 """
+    return len(string) if string.isascii() else len(string.encode())
+
+def byte_column(line, x):
+    """ utf-8 byte column of the char column x of line """
+    return x if line.isascii() else len(line[:x].encode())
+
+def char_column(line, x):
+    """ char column of the utf-8 byte column x of line """
+    if line.isascii(): return x
+    return len(line.encode()[:x].decode(errors='ignore'))
+
+
+def split_lines(text):
+    """ lines of text as reading it in text mode would give, all end with new line """
+    lines = text.replace('\r\n', '\n').split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last: lines.append(last + '\n')
+    return lines
+
+@lru_cache(maxsize=64)
+def _decode_block(block):
+    end = block.end
+    try: size = block.data.size()
+    except (OSError, ValueError): size = 0
+    if size < end:
+        # the file shrank under the map, touching a page past its end is a
+        # SIGBUS. what is gone reads as empty lines, the rope counted them.
+        end = max(block.start, size)
+        if block.on_truncated: block.on_truncated()
+    lines = split_lines(block.data[block.start:end].decode('utf-8', errors='replace'))
+    return (lines + ['\n'] * block.lines_count)[:block.lines_count]
+
+class MappedBlock():
+    """
+    A rope leaf of the lines of a block of a mapped file. The block is
+    decoded when its lines are read and only the recently read blocks are
+    kept decoded. The rope replaces it by a list of its lines to edit it.
+    on_truncated() is called when the file is found shorter than the block.
+    """
+    def __init__(self, data, start, end, on_truncated=None):
+        self.data = data
+        self.start = start
+        self.end = end
+        self.on_truncated = on_truncated
+
+        block = data[start:end]
+        self.lines_count = block.count(b'\n') + (0 if block.endswith(b'\n') else 1)
+        if block.isascii() and b'\r' not in block:
+            self.chars_count = self.bytes_count = len(block) + (0 if block.endswith(b'\n') else 1)
+        else:
+            text = block.decode('utf-8', errors='replace').replace('\r\n', '\n')
+            if not text.endswith('\n'): text += '\n'
+            self.chars_count = len(text)
+            self.bytes_count = len(text.encode())
+
+    def __len__(self): return self.lines_count
+    def __iter__(self): return iter(_decode_block(self))
+    def __getitem__(self, index): return _decode_block(self)[index]
+
+    def copy(self): return list(self)
+
+def _chunk_chars(chunk):
+    if isinstance(chunk, MappedBlock): return chunk.chars_count
+    return sum(map(len, chunk))
+
+def _chunk_bytes(chunk):
+    if isinstance(chunk, MappedBlock): return chunk.bytes_count
+    return sum(map(byte_len, chunk))
+
+
+class Snapshot():
+    """
+    The lines of a storage as they were at some version of the buffer. It
+    shares the storage leaves and is never changed, so a worker thread can
+    read it while the main thread keeps editing.
+    """
+    def __init__(self, chunks, version=None):
+        self._chunks = chunks
+        self._starts = [0] + list(accumulate(map(len, chunks)))
+        self.version = version
+
+    def __len__(self): return self._starts[-1]
+
+    def __iter__(self):
+        for chunk in self._chunks: yield from chunk
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1: return [self[y] for y in range(start, stop, step)]
+            return self._get_range(start, stop)
+
+        y = index + len(self) if index < 0 else index
+        if y < 0 or y >= len(self): raise IndexError("snapshot index out of range")
+        i = bisect_right(self._starts, y) - 1
+        return self._chunks[i][y - self._starts[i]]
+
+    def _get_range(self, start, stop):
+        result = []
+        if start >= stop: return result
+        i = bisect_right(self._starts, start) - 1
+        while i < len(self._chunks) and self._starts[i] < stop:
+            chunk_start = self._starts[i]
+            result.extend(self._chunks[i][max(0, start - chunk_start):stop - chunk_start])
+            i += 1
+        return result
+
+
+class ListStorage():
+    """
+    The original storage: a plain python list of lines. Kept as a backend
+    for small buffers and for debugging, offset queries are O(file).
+    """
+    def __init__(self, lines=()):
+        self._lines = list(lines)
+
+    def __len__(self): return len(self._lines)
+    def __iter__(self): return iter(self._lines)
+    def __getitem__(self, index): return self._lines[index]
+    def __setitem__(self, y, line): self._lines[y] = line
+
+    def insert(self, y, line): self._lines.insert(y, line)
+    def pop(self, y): return self._lines.pop(y)
+
+    def splice(self, y, count, new_lines):
+        old_lines = self._lines[y:y + count]
+        self._lines[y:y + count] = new_lines
+        return old_lines
+
+    def copy(self): return self._lines.copy()
+
+    def snapshot(self, version=None): return Snapshot([self._lines.copy()], version)
+
+    def offset_of_line(self, y):
+        return sum(len(line) for line in self._lines[:y])
+
+    def byte_offset_of_line(self, y):
+        return sum(byte_len(line) for line in self._lines[:y])
+
+    def position_of_offset(self, pos):
+        curr = 0
+        for y, line in enumerate(self._lines):
+            if curr <= pos < curr + len(line):
+                return (pos - curr, y)
+            curr += len(line)
+        return None
+
+
+class FenwickTree():
+    """
+    Prefix sums over a list of sizes, point updates and prefix queries are
+    O(log n).
+    """
+    def __init__(self, sizes=()):
+        self._build(list(sizes))
+
+    def _build(self, sizes):
+        self._sizes = sizes
+        self._tree = [0] + sizes
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self): return len(self._sizes)
+
+    def __getitem__(self, i): return self._sizes[i]
+
+    def splice(self, i, count, sizes):
+        """ replace sizes[i:i + count] with sizes, O(n) in the number of sizes """
+        self._sizes[i:i + count] = sizes
+        self._build(self._sizes)
+
+    def add(self, i, delta):
+        self._sizes[i] += delta
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        """ sum of sizes[:i] """
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def total(self): return self.prefix(len(self._sizes))
+
+    def find(self, value):
+        """
+        return (i, rest) where i is the largest index such that
+        prefix(i) <= value, and rest is value - prefix(i).
+        """
+        i = 0
+        bit = 1 << (len(self._sizes).bit_length())
+        while bit:
+            j = i + bit
+            if j < len(self._tree) and self._tree[j] <= value:
+                i = j
+                value -= self._tree[j]
+            bit >>= 1
+        return i, value
+
+
+class Rope():
+    """
+    Lines are kept in leaves (chunks) of at most 2 * CHUNK_SIZE lines, every
+    leaf knows how many lines, chars and utf-8 bytes it holds. The leaves sizes are indexed
+    by fenwick trees, so locating a line or an offset is logarithmic in the
+    number of leaves plus a bounded scan inside a single leaf. An edit updates
+    the index of the leaf it lands in. When leaves are split or dropped the
+    index is rebuilt from the sizes it caches, only the new leaves are
+    counted. Leaves shared with a snapshot are copied before they are edited.
+    """
+    def __init__(self, lines=()):
+        lines = list(lines)
+        self._chunks = [lines[i:i + CHUNK_SIZE]
+                        for i in range(0, len(lines), CHUNK_SIZE)]
+        self._len = len(lines)
+        self._shared = set() # ids of the leaves snapshots may share
+        self._reindex()
+
+    def _reindex(self):
+        self._lines_count = FenwickTree(len(chunk) for chunk in self._chunks)
+        self._chars_count = FenwickTree(map(_chunk_chars, self._chunks))
+        self._bytes_count = FenwickTree(map(_chunk_bytes, self._chunks))
+
+    def _locate(self, y):
+        """ return (chunk index, index inside chunk) of line y """
+        i, j = self._lines_count.find(y)
+        if i >= len(self._chunks):
+            i = len(self._chunks) - 1
+            j = len(self._chunks[i])
+        return i, j
+
+    def _normalize(self, y):
+        if y < 0: y += self._len
+        if y < 0 or y >= self._len: raise IndexError("rope index out of range")
+        return y
+
+    def _own(self, i):
+        """ leaf i as a list, copied first if a snapshot may share it """
+        chunk = self._chunks[i]
+        if id(chunk) in self._shared or isinstance(chunk, MappedBlock):
+            self._shared.discard(id(chunk))
+            chunk = self._chunks[i] = chunk.copy()
+        return chunk
+
+    def _replace_chunks(self, i, count, parts):
+        """ replace the leaves i to i + count with parts, O(leaves) """
+        self._shared.difference_update(map(id, self._chunks[i:i + count]))
+        self._chunks[i:i + count] = parts
+        self._lines_count.splice(i, count, list(map(len, parts)))
+        self._chars_count.splice(i, count, list(map(_chunk_chars, parts)))
+        self._bytes_count.splice(i, count, list(map(_chunk_bytes, parts)))
+
+    def __len__(self): return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks: yield from chunk
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1: return [self[y] for y in range(start, stop, step)]
+            return self._get_range(start, stop)
+
+        y = self._normalize(index)
+        i, j = self._locate(y)
+        return self._chunks[i][j]
+
+    def __setitem__(self, y, line):
+        y = self._normalize(y)
+        i, j = self._locate(y)
+        chunk = self._own(i)
+        self._chars_count.add(i, len(line) - len(chunk[j]))
+        self._bytes_count.add(i, byte_len(line) - byte_len(chunk[j]))
+        chunk[j] = line
+
+    def _get_range(self, start, stop):
+        result = []
+        if start >= stop: return result
+        i, j = self._locate(start)
+        left = stop - start
+        while left > 0 and i < len(self._chunks):
+            part = self._chunks[i][j:j + left]
+            result.extend(part)
+            left -= len(part)
+            i += 1
+            j = 0
+        return result
+
+    def insert(self, y, line):
+        self.splice(y, 0, [line])
+
+    def pop(self, y):
+        y = self._normalize(y)
+        return self.splice(y, 1, [])[0]
+
+    def splice(self, y, count, new_lines):
+        """
+        replace `count` lines starting at line `y` with `new_lines`, returns
+        the lines that were replaced.
+        """
+        if y < 0: y = max(0, y + self._len)
+        y = min(y, self._len)
+        count = max(0, min(count, self._len - y))
+
+        old_lines = self._get_range(y, y + count)
+
+        # remove the old lines. inside a leaf the leaf is edited, otherwise
+        # the leaves the range covers go at once, what is left of the first
+        # and the last one is kept.
+        if count > 0:
+            i, j = self._locate(y)
+            last, end = self._locate(y + count - 1)
+            end += 1
+            if i == last and end - j < len(self._chunks[i]):
+                chunk = self._own(i)
+                removed = chunk[j:end]
+                del chunk[j:end]
+                self._lines_count.add(i, -len(removed))
+                self._chars_count.add(i, -sum(map(len, removed)))
+                self._bytes_count.add(i, -sum(map(byte_len, removed)))
+            else:
+                kept = self._chunks[i][:j] + self._chunks[last][end:]
+                if len(kept) <= CHUNK_SIZE * 2: parts = [kept] if kept else []
+                else: parts = [part for part in (kept[:j], kept[j:]) if part]
+                self._replace_chunks(i, last - i + 1, parts)
+            self._len -= count
+
+        new_lines = list(new_lines)
+        if len(new_lines) > 0:
+            if len(self._chunks) == 0:
+                self._replace_chunks(0, 0, [[]])
+            i, j = self._locate(y)
+            chunk = self._own(i)
+            chunk[j:j] = new_lines
+            self._len += len(new_lines)
+            if len(chunk) > CHUNK_SIZE * 2:
+                parts = [chunk[k:k + CHUNK_SIZE] for k in range(0, len(chunk), CHUNK_SIZE)]
+                self._replace_chunks(i, 1, parts)
+            else:
+                self._lines_count.add(i, len(new_lines))
+                self._chars_count.add(i, sum(map(len, new_lines)))
+                self._bytes_count.add(i, sum(map(byte_len, new_lines)))
+
+        return old_lines
+
+    def copy(self): return list(self)
+
+    def snapshot(self, version=None):
+        """ the lines as they are now, O(leaves) """
+        self._shared = set(map(id, self._chunks))
+        return Snapshot(self._chunks.copy(), version)
+
+    def offset_of_line(self, y):
+        """ char offset of the beginning of line y """
+        if y <= 0: return 0
+        if y >= self._len: return self._chars_count.total()
+        i, j = self._locate(y)
+        return self._chars_count.prefix(i) + sum(map(len, self._chunks[i][:j]))
+
+    def byte_offset_of_line(self, y):
+        """ utf-8 byte offset of the beginning of line y """
+        if y <= 0: return 0
+        if y >= self._len: return self._bytes_count.total()
+        i, j = self._locate(y)
+        return self._bytes_count.prefix(i) + sum(map(byte_len, self._chunks[i][:j]))
+
+    def position_of_offset(self, pos):
+        """ (x, y) of char offset pos, None if out of the text """
+        if pos < 0 or pos >= self._chars_count.total(): return None
+
+        i, x = self._chars_count.find(pos)
+        y = self._lines_count.prefix(i)
+        for line in self._chunks[i]:
+            if x < len(line): return (x, y)
+            x -= len(line)
+            y += 1
+        return None
+
+
+def map_file(file_path, on_truncated=None):
+    """
+    A rope of the lines of file_path read through a memory map, one leaf per
+    MAP_BLOCK_SIZE bytes. Opening only counts the lines of every block, the
+    lines are decoded once they are read. on_truncated() is called, on the
+    thread reading the lines, when the file shrank since.
+    """
+    with open(file_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    rope = Rope()
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + MAP_BLOCK_SIZE - 1) + 1 or len(data)
+        rope._chunks.append(MappedBlock(data, start, end, on_truncated))
+        start = end
+    rope._len = sum(map(len, rope._chunks))
+    rope._reindex()
+    return rope
+
+def create_storage(lines=()):
+    """ storage of lines, a storage is used as it is """
+    if isinstance(lines, (Rope, ListStorage)): return lines
+    if get_setting('storage') == 'list':
+        return ListStorage(lines)
+    return Rope(lines)
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+from threading import Thread, Lock
+from select import select
+import codecs
+import time
+import os
+
+from .settings import get_setting
+from .storage import split_lines
+from .task import post
+from .log import elog
+
+# bytes read from the pipe at once.
+READ_SIZE = 64 * 1024
+# seconds between two flushes of what was read into the buffer.
+FLUSH_INTERVAL = 0.05
+
+
+class Stream():
+    """
+    Lines piped into the editor, read on a background thread and appended to
+    buffer as they come. What was read is flushed into the buffer on the main
+    thread at most every FLUSH_INTERVAL, in a single change. With the
+    stdin_max_lines setting, the first lines are dropped once the buffer
+    holds more than that.
+    """
+    def __init__(self, buffer, fd):
+        self.buffer = buffer
+        self.fd = fd
+        self.done = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._partial = '' # last line, until its new line is read
+        self._chunks = []
+        self._eof = False
+        self._scheduled = False
+        self._last_flush = 0
+        # the buffer has only its placeholder line as long as it is at this version
+        self._placeholder_version = buffer.version
+        self._lock = Lock()
+
+    def start(self):
+        Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        while True:
+            timeout = None
+            with self._lock:
+                if self._chunks and not self._scheduled:
+                    timeout = max(0, self._last_flush + FLUSH_INTERVAL - time.monotonic())
+
+            readable, _, _ = select([self.fd], [], [], timeout)
+            if readable:
+                try: data = os.read(self.fd, READ_SIZE)
+                except OSError as e:
+                    elog(f"stdin: {e}")
+                    data = b''
+                with self._lock:
+                    if data: self._chunks.append(data)
+                    else: self._eof = True
+
+            with self._lock:
+                due = time.monotonic() - self._last_flush >= FLUSH_INTERVAL
+                if not self._scheduled and (self._eof or (self._chunks and due)):
+                    self._scheduled = True
+                    post(self._flush)
+                if self._eof: return
+
+    def _flush(self):
+        with self._lock:
+            chunks = self._chunks
+            self._chunks = []
+            eof = self._eof
+            self._scheduled = False
+            self._last_flush = time.monotonic()
+
+        text = self._partial + self._decoder.decode(b''.join(chunks), final=eof)
+        lines = split_lines(text)
+        self._partial = ''
+        if not eof and not text.endswith('\n') and lines:
+            self._partial = lines.pop()[:-1]
+        if eof: self.done = True
+        if not lines: return
+
+        # what is read is not the user's change, it is not undone with it
+        if self.buffer.version == self._placeholder_version:
+            self.buffer.splice_lines(0, 1, lines, record=False)
+        else:
+            self.buffer.splice_lines(len(self.buffer.lines), 0, lines, record=False)
+
+        max_lines = get_setting('stdin_max_lines')
+        excess = len(self.buffer.lines) - max_lines
+        # lines are not dropped under a change being recorded, that would
+        # move the lines it recorded.
+        if max_lines and excess > 0 and self.buffer.change_records is None:
+            self.buffer.drop_lines(excess)
@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+from functools import lru_cache
+
+SGR = "\x1b[{};38;2;{};48;2;{}m"
+STYLE_KEYS = ('foreground', 'background', 'reverse')
+
+
+@lru_cache(None)
+def convert(a):
+    r, g, b = int(a[1:3], 16), int(a[3:5], 16), int(a[5:7], 16)
+    return f"{r};{g};{b}"
+
+
+class Style():
+    """
+    Immutable and interned: the same colors always give back the same object,
+    so styles compare by identity. sgr is the escape sequence selecting it,
+    formatted once when the style is first made.
+    For code written against the style dicts, a style can be read like one.
+    """
+    __slots__ = ('foreground', 'background', 'reverse', 'sgr')
+    _interned = {}
+
+    def __new__(cls, foreground, background, reverse=False):
+        key = (foreground, background, reverse)
+        style = cls._interned.get(key)
+        if style is not None: return style
+
+        style = super().__new__(cls)
+        object.__setattr__(style, 'foreground', foreground)
+        object.__setattr__(style, 'background', background)
+        object.__setattr__(style, 'reverse', reverse)
+        object.__setattr__(style, 'sgr', SGR.format(7 if reverse else 27,
+                                                    convert(foreground),
+                                                    convert(background)))
+        cls._interned[key] = style
+        return style
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Style is immutable")
+
+    def __copy__(self): return self
+    def __deepcopy__(self, memo): return self
+
+    def __repr__(self):
+        return f"Style({self.foreground}, {self.background}, reverse={self.reverse})"
+
+    def __contains__(self, key):
+        if key == 'reverse': return self.reverse
+        return key in STYLE_KEYS
+
+    def __getitem__(self, key):
+        if key not in self: raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in STYLE_KEYS if key in self}
@@ -2,6 +2,7 @@
 import json
 
 from .treesitter import TreeSitter
+from .storage import char_column
 from .settings import *
 from .log import elog
 
@@ -56,6 +57,105 @@ def get_syntax_highlights(  treesitter,
         yield (node, style)
 
 
+# number of lines the cache holds before it is dropped.
+MAX_CACHED_LINES = 10000
+
+def _line_runs(line, spans):
+    """
+    flatten the (start_x, end_x, style) spans of a line (byte columns, end_x
+    None for the end of the line) into sorted, non overlapping runs in chars.
+    spans nested in others are drawn over them.
+    """
+    length = len(line) - 1 if line.endswith('\n') else len(line)
+    spans = [(char_column(line, start_x),
+              length if end_x is None else min(char_column(line, end_x), length),
+              style) for start_x, end_x, style in spans]
+    spans.sort(key=lambda span: (span[0], -span[1]))
+
+    styles = [None] * length
+    for start_x, end_x, style in spans:
+        if start_x >= end_x: continue
+        styles[start_x:end_x] = [style] * (end_x - start_x)
+
+    runs = []
+    start_x = 0
+    for x in range(1, length + 1):
+        if x < length and styles[x] is styles[start_x]: continue
+        if styles[start_x] is not None: runs.append((start_x, x, styles[start_x]))
+        start_x = x
+    return runs
+
+
+class SyntaxCache():
+    """
+    The highlight runs (start_x, end_x, style) of the lines of a buffer.
+    A line is computed from the tree once, then kept until an edit touches
+    it or a reparse reports its syntax changed (Tree.changed_ranges), so
+    drawing and scrolling mostly read runs that are already there.
+    """
+    def __init__(self, treesitter):
+        self.treesitter = treesitter
+        self._runs = {}
+        self._provisional = set() # lines computed from a tree not reparsed yet
+        treesitter.listeners.append(self)
+
+    def get(self, lines, start_y, end_y):
+        """ runs of lines start_y to end_y (included), by line """
+        end_y = min(end_y, len(lines) - 1)
+        missing = [y for y in range(start_y, end_y + 1) if y not in self._runs]
+        if missing: self._fill(lines, missing[0], missing[-1])
+        return {y: self._runs[y] for y in range(start_y, end_y + 1)}
+
+    def _fill(self, lines, start_y, end_y):
+        if len(self._runs) > MAX_CACHED_LINES: self.on_reset()
+
+        spans = {y: [] for y in range(start_y, end_y + 1)}
+        for node, style in get_syntax_highlights(   self.treesitter,
+                                                    start_point=(start_y, 0),
+                                                    end_point=(end_y + 1, 0)):
+            node_start_y, node_start_x = node.start_point
+            node_end_y, node_end_x = node.end_point
+            for y in range(max(node_start_y, start_y), min(node_end_y, end_y) + 1):
+                start_x = node_start_x if y == node_start_y else 0
+                end_x = node_end_x if y == node_end_y else None
+                spans[y].append((start_x, end_x, style))
+
+        for y, line_spans in spans.items():
+            self._runs[y] = _line_runs(lines[y], line_spans)
+            if self.treesitter.parsed: self._provisional.discard(y)
+            else: self._provisional.add(y)
+
+    def on_edit(self, edit):
+        """ drop the edited lines, move the ones after them """
+        start_y = edit['start_point'][0]
+        old_end_y = edit['old_end_point'][0]
+        delta = edit['new_end_point'][0] - old_end_y
+
+        if delta == 0:
+            for y in range(start_y, old_end_y + 1):
+                self._runs.pop(y, None)
+                self._provisional.discard(y)
+            return
+
+        def move(y): return y + delta if y > old_end_y else y
+        self._runs = {move(y): runs for y, runs in self._runs.items()
+                                    if not start_y <= y <= old_end_y}
+        self._provisional = {move(y) for y in self._provisional
+                                     if not start_y <= y <= old_end_y}
+
+    def on_parsed(self, changed_ranges):
+        ranges = [(r.start_point[0], r.end_point[0]) for r in changed_ranges]
+        stale = [y for y in self._runs
+                    if y in self._provisional or
+                    any(start_y <= y <= end_y for start_y, end_y in ranges)]
+        for y in stale: del self._runs[y]
+        self._provisional.clear()
+
+    def on_reset(self):
+        self._runs = {}
+        self._provisional.clear()
+
+
 if __name__ == '__main__':
     with open('themes/monokai-color-theme.json', 'r') as f: theme = json.loads(f.read())
     with open('editor', 'rb') as f: treesitter = TreeSitter(f.read(), 'c')
@@ -4,6 +4,7 @@ from .window import *
 from .hooks import *
 from .events import *
 from .idr import *
+from .render import scheduled
 
 class Tab():
     def raise_event(func):
@@ -465,6 +466,8 @@ class Tab():
             self.zoom_mode = True
         self.draw()
 
+    @scheduled
+    @single_frame
     def draw(self):
         if self.zoom_mode:
             self.get_curr_window().draw()
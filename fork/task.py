@@ -1,9 +1,70 @@
 #!/usr/bin/python
-from threading import Thread
+from threading import Thread, Lock
+import heapq
+import time
+import os
 
 from .log import elog
 from .idr import *
 
+# callbacks posted by worker threads, the main loop runs them. a byte is
+# written to the wake pipe for each, so the main loop can wait on it together
+# with stdin.
+g_posted = []
+g_posted_lock = Lock()
+g_wake_read, g_wake_write = os.pipe()
+os.set_blocking(g_wake_read, False)
+os.set_blocking(g_wake_write, False)
+
+# (deadline, seq, callback, args) of the callbacks the main loop runs later.
+g_timers = []
+g_timers_seq = 0
+
+def wake():
+    """ wake the main loop up, safe to call from any thread and signal handler """
+    try: os.write(g_wake_write, b'\0')
+    except BlockingIOError: pass # the main loop is already woken up
+
+def post(callback, *args):
+    """ run callback(*args) on the main thread, safe to call from any thread """
+    with g_posted_lock:
+        g_posted.append((callback, args))
+    wake()
+
+def call_later(seconds, callback, *args):
+    """ run callback(*args) on the main thread in seconds, from the main thread """
+    global g_timers_seq
+    g_timers_seq += 1
+    heapq.heappush(g_timers, (time.monotonic() + seconds, g_timers_seq, callback, args))
+
+def timers_timeout():
+    """ seconds until the next timer is due, None without timers """
+    if not g_timers: return None
+    return max(0, g_timers[0][0] - time.monotonic())
+
+def run_timers():
+    now = time.monotonic()
+    while g_timers and g_timers[0][0] <= now:
+        _, _, callback, args = heapq.heappop(g_timers)
+        try: callback(*args)
+        except Exception as e: elog(f"timer callback failed: {e}", type="ERROR")
+
+def wake_fd(): return g_wake_read
+
+def run_posted():
+    global g_posted
+    try:
+        while os.read(g_wake_read, 4096): pass
+    except BlockingIOError: pass
+
+    with g_posted_lock:
+        posted = g_posted
+        g_posted = []
+
+    for callback, args in posted:
+        try: callback(*args)
+        except Exception as e: elog(f"posted callback failed: {e}", type="ERROR")
+
 
 class Task():
     def __init__(self, callback, arg):
@@ -2,24 +2,18 @@
 from .settings import INSTALLATION_PATH
 from .common import Scope
 from .log import elog
+from .task import Task, post
+from .storage import byte_column
 
 from tree_sitter import Language, Parser
-import tree_sitter_python
-import tree_sitter_c
-import tree_sitter_bash
-import tree_sitter_cpp
-import tree_sitter_css
-import tree_sitter_go
-import tree_sitter_html
-import tree_sitter_java
-import tree_sitter_javascript
-import tree_sitter_php
-import tree_sitter_ruby
-import tree_sitter_rust
-import tree_sitter_c_sharp
-import tree_sitter_json
+from bisect import bisect_left
 from os import path
+import importlib
 import traceback
+import time
+
+# a background parse holds the GIL for at most that long at a time.
+PARSE_SLICE_MICROS = 5000
 
 
 def walk(node, cb, level=0, nth_child=0):
@@ -65,140 +59,149 @@ def traverse_tree(tree, cb):
                 retracing = False
 
 
-def static_init(cls):
-    if getattr(cls, "static_init", None):
-        cls.static_init()
-        return cls
+def _module_language(module, function='language'):
+    def load():
+        return Language(getattr(importlib.import_module(module), function)())
+    return load
+
+def _library_language(lib_path, name):
+    def load():
+        from ctypes import c_void_p, cdll
+        from typing import Callable, List, Optional, Union
+        try:
+            lib = cdll.LoadLibrary(path.join(INSTALLATION_PATH, lib_path))
+            language_function: Callable[[],int] = getattr(lib, f"tree_sitter_{name}")
+            language_function.restype = c_void_p
+            return Language(language_function())
+        except Exception as e:
+            elog(f"Exception: {e}")
+        return None
+    return load
+
+# language name: how to load its grammar. grammars are loaded the first time
+# a buffer of their language is opened, not at startup.
+LANGUAGES = {
+    'python':       _module_language('tree_sitter_python'),
+    'c':            _module_language('tree_sitter_c'),
+    'bash':         _module_language('tree_sitter_bash'),
+    'cpp':          _module_language('tree_sitter_cpp'),
+    'css':          _module_language('tree_sitter_css'),
+    'go':           _module_language('tree_sitter_go'),
+    'html':         _module_language('tree_sitter_html'),
+    'java':         _module_language('tree_sitter_java'),
+    'javascript':   _module_language('tree_sitter_javascript'),
+    'php':          _module_language('tree_sitter_php', 'language_php'),
+    'ruby':         _module_language('tree_sitter_ruby'),
+    'rust':         _module_language('tree_sitter_rust'),
+    'csharp':       _module_language('tree_sitter_c_sharp'),
+    'json':         _module_language('tree_sitter_json'),
+    'markdown':     _library_language(
+        "ts_parsers/tree-sitter-markdown/tree-sitter-markdown/libtree-sitter-markdown.so", 'markdown'),
+    'zig':          _library_language(
+        "./ts_parsers/tree-sitter-zig/libtree-sitter-zig.so", 'zig'),
+}
+
+# shared by all the buffers of a language, so opening another file of a
+# language does not read and compile its queries again.
+g_languages = {} # language: loaded grammar
+g_queries = {} # (language, query source or None for highlights): query
+g_parsers = {} # language: parsers not in use
+
+def is_supported(language):
+    return language in LANGUAGES
+
+def get_language(language):
+    if language not in LANGUAGES:
+        raise Exception("treesitter not support that language.. :(")
+    if language not in g_languages: g_languages[language] = LANGUAGES[language]()
+    return g_languages[language]
+
+def get_query(language, source):
+    """ the query of source compiled for language, compiled once """
+    key = (language, source)
+    if key not in g_queries: g_queries[key] = get_language(language).query(source)
+    return g_queries[key]
+
+def get_highlights_query(language):
+    key = (language, None)
+    if key not in g_queries:
+        query_path = path.join(INSTALLATION_PATH, f"grammars/{language}/highlights.scm")
+        with open(query_path, "r") as f: source = f.read()
+        g_queries[key] = get_language(language).query(source)
+    return g_queries[key]
+
+def acquire_parser(language):
+    parsers = g_parsers.get(language)
+    if parsers: return parsers.pop()
+    parser = Parser()
+    parser.set_language(get_language(language))
+    return parser
+
+def release_parser(language, parser):
+    parser.reset()
+    parser.timeout_micros = 0
+    g_parsers.setdefault(language, []).append(parser)
+
 
-@static_init
 class TreeSitter():
-    @classmethod
-    def static_init(cls):
-        def load_language(path, name):
-            from ctypes import c_void_p, cdll
-            from typing import Callable, List, Optional, Union
-            try:
-                lib = cdll.LoadLibrary(path)
-                language_function: Callable[[],int] = getattr(lib, f"tree_sitter_{name}")
-                language_function.restype = c_void_p
-                return Language(language_function())
-            except Exception as e:
-                elog(f"Exception: {e}")
-            return None
-
-        cls.PYTHON_LANGUAGE =       Language(tree_sitter_python.language())
-        cls.C_LANGUAGE =            Language(tree_sitter_c.language())
-        cls.BASH_LANGUAGE =         Language(tree_sitter_bash.language())
-        cls.CPP_LANGUAGE =          Language(tree_sitter_cpp.language())
-        cls.CSS_LANGUAGE =          Language(tree_sitter_css.language())
-        cls.GO_LANGUAGE =           Language(tree_sitter_go.language())
-        cls.HTML_LANGUAGE =         Language(tree_sitter_html.language())
-        cls.JAVA_LANGUAGE =         Language(tree_sitter_java.language())
-        cls.JAVASCRIPT_LANGUAGE =   Language(tree_sitter_javascript.language())
-        cls.PHP_LANGUAGE =          Language(tree_sitter_php.language_php())
-        cls.RUBY_LANGUAGE =         Language(tree_sitter_ruby.language())
-        cls.RUST_LANGUAGE =         Language(tree_sitter_rust.language())
-        cls.CSHARP_LANGUAGE =       Language(tree_sitter_c_sharp.language())
-        cls.JSON_LANGUAGE =         Language(tree_sitter_json.language())
-        lib_path = path.join(INSTALLATION_PATH,
-                            "ts_parsers/tree-sitter-markdown/tree-sitter-markdown/libtree-sitter-markdown.so")
-        cls.MARKDOWN_LANGUAGE =     load_language(lib_path, 'markdown')
-        lib_path = path.join(INSTALLATION_PATH,
-                            "./ts_parsers/tree-sitter-zig/libtree-sitter-zig.so")
-        cls.ZIG_LANGUAGE =     load_language(lib_path, 'zig')
-
-    def __init__(self, file_bytes, language):
-        self._initialize_language(language)
+    def __init__(self, file_bytes, language, get_lines=None):
         self.language = language
+        self.get_lines = get_lines # the lines of the text, for char columns
+        self._initialize_language(language)
 
         self.tree = self.parser.parse(file_bytes)
         self.captures = None
+        self._methods = None
+        self.listeners = [] # told about edits and reparses (SyntaxCache)
+        self.parsed = True # the tree was parsed after the last edit
+
+        # background parsing (syntax: async)
+        self.generation = 0 # bumped by every edit
+        self._reset_generation = 0 # last async resync
+        self._pending_edits = [] # edits the next background parse applies
+        self._base_tree = None # tree owned by the background parse
+        self._parsing = False
+        self._needs_parse = False
+        self._async_parser = None
+        self._snapshot = None
+        self._on_parsed = None
+        self._closed = False
 
     def _initialize_language(self, language):
-        self.parser = Parser()
-        query_path = path.join(INSTALLATION_PATH, "grammars/{}/highlights.scm")
-
+        self.parser = None
         try:
-            if language == 'python':
-                self._language = TreeSitter.PYTHON_LANGUAGE
-                with open(query_path.format("python"),"r") as f: query = f.read()
-                self.query = TreeSitter.PYTHON_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.PYTHON_LANGUAGE)
-            elif language == 'c':
-                self._language = TreeSitter.C_LANGUAGE
-                with open(query_path.format("c"),"r") as f: query = f.read()
-                self.query = TreeSitter.C_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.C_LANGUAGE)
-            elif language == 'json':
-                self._language = TreeSitter.JSON_LANGUAGE
-                with open(query_path.format("json"),"r") as f: query = f.read()
-                self.query = TreeSitter.JSON_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.JSON_LANGUAGE)
-            elif language == 'java':
-                self._language = TreeSitter.JAVA_LANGUAGE
-                with open(query_path.format("java"),"r") as f: query = f.read()
-                self.query = TreeSitter.JAVA_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.JAVA_LANGUAGE)
-            elif language == 'javascript':
-                self._language = TreeSitter.JAVASCRIPT_LANGUAGE
-                with open(query_path.format("javascript"),"r") as f: query = f.read()
-                self.query = TreeSitter.JAVASCRIPT_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.JAVASCRIPT_LANGUAGE)
-            elif language == 'smali':
-                self._language = TreeSitter.SMALI_LANGUAGE
-                with open(query_path.format("smali"),"r") as f: query = f.read()
-                self.query = TreeSitter.SMALI_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.SMALI_LANGUAGE)
-            elif language == 'markdown':
-                self._language = TreeSitter.MARKDOWN_LANGUAGE
-                with open(query_path.format("markdown"),"r") as f: query = f.read()
-                self.query = TreeSitter.MARKDOWN_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.MARKDOWN_LANGUAGE)
-            elif language == 'cpp':
-                self._language = TreeSitter.CPP_LANGUAGE
-                with open(query_path.format("cpp"),"r") as f: query = f.read()
-                self.query = TreeSitter.CPP_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.CPP_LANGUAGE)
-            elif language == 'rust':
-                self._language = TreeSitter.RUST_LANGUAGE
-                with open(query_path.format("rust"),"r") as f: query = f.read()
-                self.query = TreeSitter.RUST_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.RUST_LANGUAGE)
-            elif language == 'go':
-                self._language = TreeSitter.GO_LANGUAGE
-                with open(query_path.format("go"),"r") as f: query = f.read()
-                self.query = TreeSitter.GO_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.GO_LANGUAGE)
-            elif language == 'zig':
-                self._language = TreeSitter.ZIG_LANGUAGE
-                with open(query_path.format("zig"),"r") as f: query = f.read()
-                self.query = TreeSitter.ZIG_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.ZIG_LANGUAGE)
-            elif language == 'bash':
-                self._language = TreeSitter.BASH_LANGUAGE
-                with open(query_path.format("bash"),"r") as f: query = f.read()
-                self.query = TreeSitter.BASH_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.BASH_LANGUAGE)
-            elif language == 'html':
-                self._language = TreeSitter.HTML_LANGUAGE
-                with open(query_path.format("html"),"r") as f: query = f.read()
-                self.query = TreeSitter.HTML_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.HTML_LANGUAGE)
-            elif language == 'css':
-                self._language = TreeSitter.CSS_LANGUAGE
-                with open(query_path.format("css"),"r") as f: query = f.read()
-                self.query = TreeSitter.CSS_LANGUAGE.query(query)
-                self.parser.set_language(TreeSitter.CSS_LANGUAGE)
-            else:
-                raise Exception("treesitter not support that language.. :(")
+            self.query = get_highlights_query(language)
+            self.parser = acquire_parser(language)
         except Exception as e: elog(f"Exception: {e}")
 
+    def _query(self, source):
+        return get_query(self.language, source)
+
+    def close(self):
+        """ give the parsers back to the pool, the tree is not usable after """
+        self._closed = True
+        if self.parser:
+            release_parser(self.language, self.parser)
+            self.parser = None
+        # a parser still parsing in the background goes back when done
+        if self._async_parser and not self._parsing:
+            release_parser(self.language, self._async_parser)
+            self._async_parser = None
+
     def resync(self, file_bytes):
         self.tree = self.parser.parse(file_bytes)
         self.captures = None
-
-    def edit(self, edit, new_file_bytes):
-        self.tree.edit(
+        self._methods = None
+        self.parsed = True
+        for listener in self.listeners: listener.on_reset()
+        # drop whatever the background parse is doing
+        self.generation += 1
+        self._reset_generation = self.generation
+        self._pending_edits = []
+        self._needs_parse = False
+
+    def _apply_edit(self, tree, edit):
+        tree.edit(
                 start_byte=edit['start_byte'],
                 old_end_byte=edit['old_end_byte'],
                 new_end_byte=edit['new_end_byte'],
@@ -206,8 +209,120 @@ class TreeSitter():
                 old_end_point=edit['old_end_point'],
                 new_end_point=edit['new_end_point']
                 )
+
+    def edit(self, edits, new_file_bytes):
+        """ apply edits, in order, to the tree and reparse it once """
+        for edit in edits:
+            self._apply_edit(self.tree, edit)
+            for listener in self.listeners: listener.on_edit(edit)
         self.captures = None # reset cache.
-        self.tree = self.parser.parse(new_file_bytes, self.tree)
+        self._methods = None
+        self.generation += 1
+
+        old_tree = self.tree
+        self.tree = self.parser.parse(new_file_bytes, old_tree)
+        self.parsed = True
+        changed_ranges = old_tree.changed_ranges(self.tree)
+        for listener in self.listeners: listener.on_parsed(changed_ranges)
+
+    def edit_async(self, edits, snapshot, on_parsed=None):
+        """
+        Apply edits to the current tree right away and reparse in the
+        background. snapshot() returns the lines of the buffer, it is called
+        on the main thread when a parse starts. on_parsed() is called on the
+        main thread when a tree of the latest edits lands.
+        """
+        for edit in edits:
+            self._apply_edit(self.tree, edit)
+            for listener in self.listeners: listener.on_edit(edit)
+        self.captures = None
+        self._methods = None
+        self.parsed = False
+        self._pending_edits.extend(edits)
+        self._schedule(snapshot, on_parsed)
+
+    def resync_async(self, snapshot, on_parsed=None):
+        """ full reparse in the background, the current tree is kept until then """
+        self._pending_edits = []
+        self._base_tree = None
+        self._reset_generation = self.generation + 1
+        self._schedule(snapshot, on_parsed)
+
+    def _schedule(self, snapshot, on_parsed):
+        self.generation += 1
+        self._snapshot = snapshot
+        self._on_parsed = on_parsed
+        self._needs_parse = True
+        if not self._parsing: self._start_parse()
+
+    def _start_parse(self):
+        if not self._async_parser:
+            self._async_parser = acquire_parser(self.language)
+
+        self._parsing = True
+        self._needs_parse = False
+        generation = self.generation
+        edits = self._pending_edits
+        self._pending_edits = []
+        base = self._base_tree
+        self._base_tree = None
+        lines = self._snapshot()
+        parser = self._async_parser
+
+        def parse(_):
+            try:
+                source = ''.join(lines).encode()
+                if base:
+                    for edit in edits: self._apply_edit(base, edit)
+
+                # parse in slices, releasing the GIL in between so the main
+                # thread keeps handling keys.
+                parser.timeout_micros = PARSE_SLICE_MICROS
+                while True:
+                    try:
+                        tree = parser.parse(source, base) if base else parser.parse(source)
+                        break
+                    except ValueError: time.sleep(0) # timed out, resumes on next call
+
+                # a second tree of the same content, the next background
+                # parse edits it while the main thread uses the first one.
+                parser.timeout_micros = 0
+                return tree, parser.parse(source, tree)
+            except Exception as e:
+                elog(f"background parse failed: {e}")
+                parser.reset()
+                return None
+
+        task = Task(parse, None)
+        fresh = base is None
+        task.on_done(lambda ret: post(self._on_parse_done, generation, ret, fresh))
+        task.start()
+
+    def _on_parse_done(self, generation, ret, fresh):
+        self._parsing = False
+        if self._closed:
+            release_parser(self.language, self._async_parser)
+            self._async_parser = None
+            return
+        if ret:
+            tree, base = ret
+            if generation >= self._reset_generation: self._base_tree = base
+
+            if generation == self.generation:
+                # a tree parsed from scratch has nothing to compare with
+                changed_ranges = None if fresh else self.tree.changed_ranges(tree)
+                self.tree = tree
+                self.captures = None
+                self._methods = None
+                self.parsed = True
+                for listener in self.listeners:
+                    if changed_ranges is None: listener.on_reset()
+                    else: listener.on_parsed(changed_ranges)
+                if self._on_parsed: self._on_parsed()
+                return
+
+        # edits arrived meanwhile, that tree is stale.
+        if self._needs_parse: self._start_parse()
 
     def get_captures(self, node=None, start_point=None, end_point=None):
         if not node: target_node = self.tree.root_node
@@ -217,46 +332,42 @@ class TreeSitter():
                                         start_point=start_point,
                                         end_point=end_point))
 
-    def _get_relevant_nodes(self, node, query, x=None, y=None, most_relevant=False):
-        if x is None or y is None:
-            captures = query.captures(node)
-        else:
-            captures = query.captures(  node,
-                                        start_point=[y-1 if y > 0 else y, 0],
-                                        end_point=[y+1, 0])
-
-        if most_relevant: captures = reversed(captures)
-
-        for node, name in captures:
-            if x is None or y is None:
-                return node
-
-            start_y = node.start_point[0]
-            start_x = node.start_point[1]
-            end_y = node.end_point[0]
-            end_x = node.end_point[1]
-
-            if start_y > y: continue
-            if end_y < y: continue
-            if start_y == y and start_x > x: continue
-            if end_y == y and end_x < x: continue
-            return node
+    def _child(self, node, *types):
+        """ follow the path of types down from node, first child of each type """
+        for node_type in types:
+            if not node: return None
+            node = next((c for c in node.children if c.type == node_type), None)
+        return node
+
+    def _node_at(self, x, y, types, *child):
+        """
+        the innermost node of one of types around (x, y), found by descending
+        to the smallest node at the point and walking up its parents. with
+        child, the first such node that has that child path, and the child.
+        """
+        # the columns of the tree are utf-8 bytes
+        if self.get_lines: x = byte_column(self.get_lines()[y], x)
+        node = self.tree.root_node.descendant_for_point_range((y, x), (y, x))
+        while node:
+            if node.type in types:
+                if not child: return node
+                found = self._child(node, *child)
+                if found: return found
+            node = node.parent
         return None
 
+    def _method_starts(self):
+        """ start points of the methods of the tree, in order, cached per tree """
+        if self._methods is None:
+            query = self._query("(function_definition) @name")
+            self._methods = [method.start_point for method, name in query.captures(self.tree.root_node)]
+        return self._methods
+
     def get_inner_if(self, x, y):
-        x += 1
         if self.language == 'python':
-            query = self._language.query("""
-            (if_statement) @name
-            (elif_clause) @name
-            """)
-            node = self._get_relevant_nodes(self.tree.root_node, query, x,y, most_relevant=True)
+            node = self._node_at(x, y, ('if_statement', 'elif_clause'))
             if not node: return None
-            query = self._language.query("""
-            (if_statement (block) @name)
-            (elif_clause (block) @name)
-            """)
-            node = self._get_relevant_nodes(node, query)
+            node = self._child(node, 'block')
             if not node: return None
 
             start_y = node.start_point[0]
@@ -267,8 +378,7 @@ class TreeSitter():
             return Scope(start_x, start_y, end_x, end_y)
 
         if self.language == 'c':
-            query = self._language.query("(if_statement (compound_statement) @name)")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('if_statement',), 'compound_statement')
             if not node: return None
 
             start_y = node.start_point[0]
@@ -283,13 +393,8 @@ class TreeSitter():
         return None
 
     def get_arround_if(self, x, y):
-        x += 1
         if self.language == 'python':
-            query = self._language.query("""
-            (if_statement) @name
-            (elif_clause) @name
-            """)
-            node = self._get_relevant_nodes(self.tree.root_node, query, x,y, most_relevant=True)
+            node = self._node_at(x, y, ('if_statement', 'elif_clause'))
             if not node: return None
 
             start_y = node.start_point[0]
@@ -300,8 +405,7 @@ class TreeSitter():
             return Scope(start_x, start_y, end_x, end_y)
 
         if self.language == 'c':
-            query = self._language.query("(if_statement) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('if_statement',))
             if not node: return None
 
             start_y = node.start_point[0]
@@ -313,13 +417,8 @@ class TreeSitter():
         return None
 
     def get_inner_IF(self, x, y):
-        x += 1
         if self.language == 'python':
-            query = self._language.query("""
-            (if_statement) @name
-            (elif_clause) @name
-            """)
-            node = self._get_relevant_nodes(self.tree.root_node, query, x,y, most_relevant=True)
+            node = self._node_at(x, y, ('if_statement', 'elif_clause'))
             if not node: return None
 
             node_start_y = node.start_point[0]
@@ -352,11 +451,9 @@ class TreeSitter():
             return Scope(start_x, start_y, end_x, end_y)
 
         if self.language == 'c':
-            query = self._language.query("(if_statement) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x,y, most_relevant=True)
+            node = self._node_at(x, y, ('if_statement',))
             if not node: return None
-            query = self._language.query("(if_statement (parenthesized_expression) @name)")
-            node = self._get_relevant_nodes(node, query)
+            node = self._child(node, 'parenthesized_expression')
             if not node: return None
 
             start_y = node.start_point[0]
@@ -371,10 +468,8 @@ class TreeSitter():
         return None
 
     def get_inner_method(self, x, y):
-        x += 1
         if self.language == 'python':
-            query = self._language.query("(function_definition (block) @name)")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x,y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',), 'block')
             if not node: return None
 
             start_y = node.start_point[0]
@@ -385,8 +480,7 @@ class TreeSitter():
             return Scope(start_x, start_y, end_x, end_y)
 
         if self.language == 'c':
-            query = self._language.query("(function_definition (compound_statement) @name)")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',), 'compound_statement')
             if not node: return None
 
             start_y = node.start_point[0]
@@ -402,10 +496,8 @@ class TreeSitter():
         return None
 
     def get_arround_method(self, x, y):
-        x += 1 # index is out of sync?
         if self.language == 'python':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x,y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
 
             start_y = node.start_point[0]
@@ -416,8 +508,7 @@ class TreeSitter():
             return Scope(start_x, start_y, end_x, end_y)
 
         if self.language == 'c':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
 
             start_y = node.start_point[0]
@@ -429,13 +520,10 @@ class TreeSitter():
         return None
 
     def get_inner_METHOD(self, x, y):
-        x += 1
         if self.language == 'python':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
-            query = self._language.query("(function_definition (parameters) @name)")
-            node = self._get_relevant_nodes(node, query)
+            node = self._child(node, 'parameters')
             if not node: return None
 
             start_y = node.start_point[0]
@@ -448,11 +536,9 @@ class TreeSitter():
             return Scope(start_x, start_y, end_x, end_y)
 
         if self.language == 'c':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
-            query = self._language.query("(function_definition (function_declarator (parameter_list) @name))")
-            node = self._get_relevant_nodes(node, query)
+            node = self._child(node, 'function_declarator', 'parameter_list')
             if not node: return None
 
             start_y = node.start_point[0]
@@ -468,13 +554,10 @@ class TreeSitter():
         return None
 
     def get_arround_METHOD(self, x, y):
-        x += 1 # index is out of sync?
         if self.language == 'python':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
-            query = self._language.query("(function_definition (identifier) @name)")
-            node = self._get_relevant_nodes(node, query)
+            node = self._child(node, 'identifier')
             if not node: return None
 
             start_y = node.start_point[0]
@@ -485,11 +568,9 @@ class TreeSitter():
             return Scope(start_x, start_y, end_x, end_y)
 
         if self.language == 'c':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
-            query = self._language.query("(function_definition (function_declarator (identifier) @name))")
-            node = self._get_relevant_nodes(node, query)
+            node = self._child(node, 'function_declarator', 'identifier')
             if not node: return None
 
             start_y = node.start_point[0]
@@ -502,13 +583,10 @@ class TreeSitter():
         return None
 
     def get_arround_argument(self, x, y):
-        x += 1 # index is out of sync?
         if self.language == 'python':
-            query = self._language.query("""
-            (argument_list) @name
-            """)
-            node = self._get_relevant_nodes(self.tree.root_node, query, x,y, most_relevant=True)
+            node = self._node_at(x, y, ('argument_list',))
             if not node: return None
+            x += 1 # index is out of sync?
 
             for parameter in node.children:
                 start_y = parameter.start_point[0]
@@ -525,11 +603,9 @@ class TreeSitter():
                 return Scope(start_x, start_y, end_x, end_y)
 
         if self.language == 'c':
-            query = self._language.query("""
-            (argument_list) @name
-            """)
-            node = self._get_relevant_nodes(self.tree.root_node, query, x,y, most_relevant=True)
+            node = self._node_at(x, y, ('argument_list',))
             if not node: return None
+            x += 1 # index is out of sync?
 
             for parameter in node.children:
                 start_y = parameter.start_point[0]
@@ -547,56 +623,32 @@ class TreeSitter():
         return None
 
     def get_next_method(self, x, y):
-        x += 1
-        if self.language == 'python':
-            query = self._language.query("(function_definition) @name")
-            methods = query.captures(self.tree.root_node)
-            for method, name in methods:
-                method_x = method.start_point[1]
-                method_y = method.start_point[0]
-                if method_y > y: return method_x, method_y
-            return None
-        if self.language == 'c':
-            query = self._language.query("(function_definition) @name")
-            methods = query.captures(self.tree.root_node)
-            for method, name in methods:
-                method_x = method.start_point[1]
-                method_y = method.start_point[0]
-                if method_y > y: return method_x, method_y
-            return None
+        if self.language in ('python', 'c'):
+            methods = self._method_starts()
+            i = bisect_left(methods, (y + 1, 0))
+            if i == len(methods): return None
+            method_y, method_x = methods[i]
+            return method_x, method_y
         return None
 
     def get_prev_method(self, x, y):
-        x += 1
-        if self.language == 'python':
-            query = self._language.query("(function_definition) @name")
-            methods = query.captures(self.tree.root_node)
-            for method, name in reversed(methods):
-                method_x = method.start_point[1]
-                method_y = method.start_point[0]
-                if method_y < y: return method_x, method_y
-            return None
-        if self.language == 'c':
-            query = self._language.query("(function_definition) @name")
-            methods = query.captures(self.tree.root_node)
-            for method, name in reversed(methods):
-                method_x = method.start_point[1]
-                method_y = method.start_point[0]
-                if method_y < y: return method_x, method_y
-            return None
+        if self.language in ('python', 'c'):
+            methods = self._method_starts()
+            i = bisect_left(methods, (y, 0))
+            if i == 0: return None
+            method_y, method_x = methods[i - 1]
+            return method_x, method_y
         return None
 
     def get_method_end(self, x, y):
         if self.language == 'python':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
             method_x = node.end_point[1]
             method_y = node.end_point[0]
             return method_x, method_y
         if self.language == 'c':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
             method_x = node.end_point[1]
             method_y = node.end_point[0]
@@ -605,15 +657,13 @@ class TreeSitter():
 
     def get_method_begin(self, x, y):
         if self.language == 'python':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
             method_x = node.start_point[1]
             method_y = node.start_point[0]
             return method_x, method_y
         if self.language == 'c':
-            query = self._language.query("(function_definition) @name")
-            node = self._get_relevant_nodes(self.tree.root_node, query, x, y, most_relevant=True)
+            node = self._node_at(x, y, ('function_definition',))
             if not node: return None
             method_x = node.start_point[1]
             method_y = node.start_point[0]
@@ -0,0 +1,369 @@
+#!/usr/bin/python3
+from .settings import get_setting, EDITOR_HOME_PATH
+from .log import elog
+
+from os import path
+import hashlib
+import struct
+import zlib
+import os
+
+# rough cost of holding a line in a record, on top of its chars.
+LINE_OVERHEAD = 64
+
+UNDO_FILE_MAGIC = b'FORKUNDO\x01'
+NODE_BLOCK = 1
+CHECKPOINT_BLOCK = 2
+
+
+def add_record(records, y, old_lines, new_lines):
+    """
+    Append the splice (y, old_lines, new_lines) to the records of a change.
+    A splice that lands inside the lines produced by the previous record is
+    merged into it, so typing in insert mode keeps a single record per block
+    of touched lines instead of one per keystroke.
+    """
+    if len(records) > 0:
+        last_y, last_old_lines, last_new_lines = records[-1]
+        if last_y <= y and y + len(old_lines) <= last_y + len(last_new_lines):
+            i = y - last_y
+            merged = last_new_lines[:i] + new_lines + last_new_lines[i + len(old_lines):]
+            records[-1] = (last_y, last_old_lines, merged)
+            return
+    records.append((y, old_lines, new_lines))
+
+def records_size(records):
+    size = 0
+    for y, old_lines, new_lines in records:
+        for line in old_lines: size += len(line) + LINE_OVERHEAD
+        for line in new_lines: size += len(line) + LINE_OVERHEAD
+    return size
+
+
+class UndoNode():
+    def __init__(self, seq, parent, change, start_position, end_position):
+        self.seq = seq
+        self.parent = parent
+        self.children = []
+        self.curr_child = None # the child redo goes to
+        self.depth = parent.depth + 1 if parent else 0
+
+        self.change = change
+        self.start_position = start_position
+        self.end_position = end_position
+        self.size = records_size(change) if change else 0
+
+
+class UndoTree():
+    """
+    Every change is a node holding the splices recorded while it was made,
+    its parent is the state it was made on. Undo/redo walk up and down the
+    current branch, earlier/later walk the changes in the order they were
+    made, across branches (like vim's g-/g+).
+    The history is capped by the undo_memory setting, the oldest changes are
+    evicted first.
+    """
+    def __init__(self):
+        self.seq = 0
+        self.root = UndoNode(0, None, None, None, None)
+        self.current = self.root
+        self.nodes = {0: self.root}
+        self.size = 0
+        self.saved_seq = 0 # changes up to here are in the undo file
+
+    def push(self, change, start_position, end_position):
+        self.seq += 1
+        node = UndoNode(self.seq,
+                        self.current,
+                        change,
+                        start_position,
+                        end_position)
+        self.current.children.append(node)
+        self.current.curr_child = node
+        self.current = node
+        self.nodes[node.seq] = node
+        self.size += node.size
+        self._evict()
+        return node
+
+    def graft(self, tree):
+        """
+        Attach the changes of tree under the current node, tree's root must be
+        the current state. Its changes are renumbered to come after ours.
+        """
+        base = self.current
+        offset = self.seq
+        for node in sorted(tree.nodes.values(), key=lambda node: node.seq):
+            if node is tree.root: continue
+            node.seq += offset
+            node.depth += base.depth
+            self.nodes[node.seq] = node
+
+        for child in tree.root.children:
+            child.parent = base
+            base.children.append(child)
+        if tree.root.curr_child: base.curr_child = tree.root.curr_child
+
+        if tree.current is not tree.root: self.current = tree.current
+        self.seq = offset + tree.seq
+        self.size += tree.size
+        self._evict()
+
+    def undo(self):
+        """ return the node to undo, None if at the oldest change """
+        node = self.current
+        if node is self.root: return None
+        node.parent.curr_child = node
+        self.current = node.parent
+        return node
+
+    def redo(self):
+        """ return the node to redo, None if at the newest change """
+        node = self.current.curr_child
+        if not node: return None
+        self.current = node
+        return node
+
+    def peek_undo(self):
+        if self.current is self.root: return None
+        return self.current
+
+    def _find_seq(self, seq, step):
+        while 0 <= seq <= self.seq:
+            if seq in self.nodes: return self.nodes[seq]
+            seq += step
+        return None
+
+    def _path(self, target):
+        """ the nodes to undo and then the nodes to redo to reach target """
+        to_undo = []
+        to_redo = []
+        a = self.current
+        b = target
+        while a is not b:
+            if a.depth >= b.depth:
+                to_undo.append(a)
+                a = a.parent
+            else:
+                to_redo.append(b)
+                b = b.parent
+        to_redo.reverse()
+        return to_undo, to_redo
+
+    def travel(self, step):
+        """
+        go to the change made step changes before (negative) or after the
+        current one, returns the nodes to undo and the nodes to redo.
+        """
+        seq = self.current.seq + step
+        if seq < self.root.seq: seq = self.root.seq
+        target = self._find_seq(seq, -1 if step < 0 else 1)
+        if not target: return [], []
+
+        to_undo, to_redo = self._path(target)
+        for node in to_undo:
+            node.parent.curr_child = node
+        for node in to_redo:
+            node.parent.curr_child = node
+        self.current = target
+        return to_undo, to_redo
+
+    def drop_lines(self, count):
+        """
+        The first count lines are gone, the changes move up with the lines.
+        Returns False, with nothing moved, when a change touched them.
+        """
+        nodes = [node for node in self.nodes.values() if node.change]
+        for node in nodes:
+            if any(y < count for y, old_lines, new_lines in node.change): return False
+
+        for node in nodes:
+            node.change = [(y - count, old_lines, new_lines) for y, old_lines, new_lines in node.change]
+            x, y = node.start_position
+            node.start_position = (x, max(0, y - count))
+            x, y = node.end_position
+            node.end_position = (x, max(0, y - count))
+        return True
+
+    def _drop(self, node):
+        stack = [node]
+        while stack:
+            curr = stack.pop()
+            stack.extend(curr.children)
+            del self.nodes[curr.seq]
+            self.size -= curr.size
+
+    def _evict(self):
+        max_size = get_setting('undo_memory')
+        while self.size > max_size and len(self.root.children) > 0:
+            # the curr_child chain leads from the root to the current node,
+            # children are in the order they were made.
+            on_branch = self.root.curr_child if self.current is not self.root else None
+            branch = next((c for c in self.root.children if c is not on_branch), None)
+            if branch:
+                # the oldest branch the user is not on goes first
+                self.root.children.remove(branch)
+                if self.root.curr_child is branch:
+                    self.root.curr_child = None
+                self._drop(branch)
+                continue
+
+            # only the current branch is left, its first change becomes
+            # the new root, the state before it is gone. The current change
+            # is kept, however big.
+            node = on_branch
+            if node is self.current: break
+            del self.nodes[self.root.seq]
+            self.size -= node.size
+            node.parent = None
+            node.change = None
+            node.size = 0
+            self.root = node
+
+
+def undo_file_path(file_path):
+    name = hashlib.md5(path.abspath(file_path).encode()).hexdigest()
+    return path.join(EDITOR_HOME_PATH, 'undo', name)
+
+def _pack_lines(lines):
+    parts = [struct.pack('<I', len(lines))]
+    for line in lines:
+        data = line.encode()
+        parts.append(struct.pack('<I', len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+def _unpack_lines(data, offset):
+    count, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    lines = []
+    for _ in range(count):
+        size, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        lines.append(data[offset:offset + size].decode())
+        offset += size
+    return lines, offset
+
+def _pack_block(kind, payload):
+    return struct.pack('<BI', kind, len(payload)) + payload
+
+def _pack_node(node):
+    parts = [struct.pack('<QQIIIII',
+                         node.seq,
+                         node.parent.seq,
+                         *node.start_position,
+                         *node.end_position,
+                         len(node.change))]
+    for y, old_lines, new_lines in node.change:
+        parts.append(struct.pack('<I', y))
+        parts.append(_pack_lines(old_lines))
+        parts.append(_pack_lines(new_lines))
+    return _pack_block(NODE_BLOCK, zlib.compress(b''.join(parts)))
+
+def _unpack_node(payload):
+    data = zlib.decompress(payload)
+    seq, parent_seq, sx, sy, ex, ey, count = struct.unpack_from('<QQIIIII', data)
+    offset = struct.calcsize('<QQIIIII')
+    change = []
+    for _ in range(count):
+        y, = struct.unpack_from('<I', data, offset)
+        old_lines, offset = _unpack_lines(data, offset + 4)
+        new_lines, offset = _unpack_lines(data, offset)
+        change.append((y, old_lines, new_lines))
+    return seq, parent_seq, change, (sx, sy), (ex, ey)
+
+def write_undo_file(file_path, tree, content_hash, rewrite=False):
+    """
+    Append the changes made since the last write and a checkpoint that ties
+    content_hash (md5 hex digest of the written file) to the current change.
+    With rewrite the file is started over with the whole tree.
+    """
+    undo_path = undo_file_path(file_path)
+    try:
+        os.makedirs(path.dirname(undo_path), exist_ok=True)
+        # changes the file does not have were evicted, start it over
+        if tree.root.seq > tree.saved_seq: rewrite = True
+        if rewrite or not path.isfile(undo_path):
+            rewrite = True
+            blocks = [UNDO_FILE_MAGIC]
+            saved_seq = tree.root.seq
+        else:
+            blocks = []
+            saved_seq = tree.saved_seq
+
+        for seq in sorted(tree.nodes):
+            node = tree.nodes[seq]
+            if seq <= saved_seq or not node.change: continue
+            blocks.append(_pack_node(node))
+
+        checkpoint = bytes.fromhex(content_hash) + struct.pack('<Q', tree.current.seq)
+        blocks.append(_pack_block(CHECKPOINT_BLOCK, checkpoint))
+
+        with open(undo_path, 'wb' if rewrite else 'ab') as f:
+            f.write(b''.join(blocks))
+        tree.saved_seq = tree.seq
+        return True
+    except Exception as e:
+        elog(f"failed writing undo file {undo_path}: {e}")
+        return False
+
+def read_undo_file(file_path, content_hash):
+    """
+    Return the undo tree saved for file_path, its current change is the one
+    the file was in when its content hash was content_hash. None if there is
+    no such history.
+    """
+    undo_path = undo_file_path(file_path)
+    if not path.isfile(undo_path): return None
+    try:
+        with open(undo_path, 'rb') as f: data = f.read()
+        if not data.startswith(UNDO_FILE_MAGIC): return None
+
+        digest = bytes.fromhex(content_hash)
+        tree = UndoTree()
+        del tree.nodes[tree.root.seq]
+        current_seq = None
+
+        offset = len(UNDO_FILE_MAGIC)
+        header_size = struct.calcsize('<BI')
+        while offset + header_size <= len(data):
+            kind, size = struct.unpack_from('<BI', data, offset)
+            offset += header_size
+            payload = data[offset:offset + size]
+            offset += size
+            if len(payload) < size: break # truncated write
+
+            if kind == CHECKPOINT_BLOCK:
+                if payload[:16] == digest:
+                    current_seq, = struct.unpack_from('<Q', payload, 16)
+                continue
+            if kind != NODE_BLOCK: continue
+
+            seq, parent_seq, change, start_position, end_position = _unpack_node(payload)
+            if len(tree.nodes) == 0:
+                # the parent of the first change is the oldest state kept
+                tree.root.seq = parent_seq
+                tree.nodes[parent_seq] = tree.root
+            if parent_seq not in tree.nodes: continue
+
+            parent = tree.nodes[parent_seq]
+            node = UndoNode(seq, parent, change, start_position, end_position)
+            parent.children.append(node)
+            parent.curr_child = node
+            tree.nodes[seq] = node
+            tree.size += node.size
+            tree.seq = max(tree.seq, seq)
+
+        if current_seq not in tree.nodes: return None
+        tree.current = tree.nodes[current_seq]
+        # redo from the root leads to the current change
+        node = tree.current
+        while node.parent:
+            node.parent.curr_child = node
+            node = node.parent
+        tree.saved_seq = tree.seq
+        tree._evict()
+        return tree
+    except Exception as e:
+        elog(f"failed reading undo file {undo_path}: {e}")
+        return None
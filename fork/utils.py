@@ -4,8 +4,9 @@ import re
 from .log import elog
 
 
-def is_binary_file(file):
-    bytes = open(file, 'rb').read()
+def is_binary_file(file, size=-1):
+    """ whether the first size bytes of file (all of it by default) are binary """
+    bytes = open(file, 'rb').read(size)
     textchars = bytearray({7,8,9,10,12,13,27} | set(range(0x20, 0x100)) - {0x7f})
     return bytes.translate(None, textchars)
 
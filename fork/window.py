@@ -3,12 +3,12 @@ from .settings import *
 from .idr import *
 from .buffer import *
 from .hooks import *
-from .syntax import get_syntax_highlights, get_scope_style
+from .syntax import get_scope_style
+from .render import scheduled
 
 from .popup import *
 from .utils import *
 
-from intervaltree import Interval, IntervalTree
 from string import printable
 from copy import copy
 from os import path
@@ -37,6 +37,27 @@ class Window():
         self.move_cursor_to_buf_location(orig_x, orig_y)
         self.draw()
 
+    def on_buffer_syntax_callback(self, priv):
+        if self.tab.is_window_visible(self.id):
+            self.draw()
+
+    def on_buffer_match_count_callback(self, count):
+        if self.status_line and self.tab.is_window_visible(self.id):
+            self.draw_status_line()
+
+    def on_buffer_lines_dropped_callback(self, count):
+        # the lines on screen stay where they are, unless they are gone
+        y = self.buffer_cursor[1] - count
+        if y < 0:
+            self.window_cursor[1] = 0
+            y = 0
+        self.buffer_cursor[1] = y
+        x = min(self.buffer_cursor[0], max(0, len(self.buffer.lines[y]) - 1))
+        self.buffer_cursor[0] = self.window_cursor[0] = x
+
+        for jump in self.jumpslist:
+            if jump['buffer_id'] == self.buffer.id: jump['line'] = max(0, jump['line'] - count)
+
     def on_buffer_change_callback(self, priv):
         # this is important in case the buffer changed and now the number of lines
         # increased (or decreased) and now the needed margin has changed.
@@ -69,6 +90,9 @@ class Window():
         handlers = {}
         handlers[ON_BUFFER_RELOAD] = self.on_buffer_reload_callback
         handlers[ON_BUFFER_CHANGE] = self.on_buffer_change_callback
+        handlers[ON_BUFFER_SYNTAX] = self.on_buffer_syntax_callback
+        handlers[ON_BUFFER_MATCH_COUNT] = self.on_buffer_match_count_callback
+        handlers[ON_BUFFER_LINES_DROPPED] = self.on_buffer_lines_dropped_callback
         self.buffer.register_events(handlers)
 
         self.position = list(position)
@@ -105,12 +129,18 @@ class Window():
         handlers = {}
         handlers[ON_BUFFER_RELOAD] = self.on_buffer_reload_callback
         handlers[ON_BUFFER_CHANGE] = self.on_buffer_change_callback
+        handlers[ON_BUFFER_SYNTAX] = self.on_buffer_syntax_callback
+        handlers[ON_BUFFER_MATCH_COUNT] = self.on_buffer_match_count_callback
+        handlers[ON_BUFFER_LINES_DROPPED] = self.on_buffer_lines_dropped_callback
         self.buffer.unregister_events(handlers)
 
     def change_buffer(self, buffer):
         handlers = {}
         handlers[ON_BUFFER_RELOAD] = self.on_buffer_reload_callback
         handlers[ON_BUFFER_CHANGE] = self.on_buffer_change_callback
+        handlers[ON_BUFFER_SYNTAX] = self.on_buffer_syntax_callback
+        handlers[ON_BUFFER_MATCH_COUNT] = self.on_buffer_match_count_callback
+        handlers[ON_BUFFER_LINES_DROPPED] = self.on_buffer_lines_dropped_callback
         self.buffer.unregister_events(handlers)
 
         self.buffer = buffer
@@ -205,27 +235,19 @@ class Window():
         return ret_x, ret_y
 
     def _draw_pairs(self):
-        try:
-            if self._need_to_clear_pairs:
-                self.draw()
-                self._need_to_clear_pairs = False
+        # a full draw clears the old pair and draws the one under the cursor
+        if self._need_to_clear_pairs: self.draw()
+        else: self._paint_pairs()
 
+    def _paint_pairs(self):
+        try:
             x_1 = self.buffer_cursor[0]
             y_1 = self.buffer_cursor[1]
-            char_1 = self.get_curr_line()[x_1]
-            if char_1 not in "(){}[]": return
-
-            char_2 = self.buffer.negate_char(char_1)
-            x_2 = x_1
-            x_2 = y_1
-            if char_1 in "({[":
-                ret = self.buffer.find_next_char(x_1, y_1, char_2, smart=True)
-                if not ret: return
-                x_2, y_2 = ret
-            else:
-                ret = self.buffer.find_prev_char(x_1, y_1, char_2, smart=True)
-                if not ret: return
-                x_2, y_2 = ret
+            ret = self.buffer.find_pair(x_1, y_1)
+            if not ret: return
+            x_2, y_2 = ret
+            char_1 = self.buffer.lines[y_1][x_1]
+            char_2 = self.buffer.lines[y_2][x_2]
 
             ret = self._translate_buf_x_y_to_win_x_y(x_1, y_1)
             if not ret: return
@@ -262,26 +284,8 @@ class Window():
             x = 0
             line = self.buffer.lines[buf_y]
             line_len  = len(line) - 1
-            # the 1000s here are just encoding used when craeted the syntaxc_map at get_syntax()
-            start_pos = buf_y * 1000
-            end_pos = buf_y * 1000 + line_len
-            syntax = sorted(list(syntax_map[start_pos:end_pos]))
-
-            syntax_start_x = 0
-            syntax_end_x = 0
-            while len(syntax) > 0:
-                curr_syntax = syntax.pop(0)
-                curr_style = copy(curr_syntax.data) # do not change the syntax
-
-                if curr_syntax.begin <= start_pos:
-                    syntax_start_x = 0
-                else:
-                    syntax_start_x = curr_syntax.begin - start_pos
-
-                if curr_syntax.end >= end_pos:
-                    syntax_end_x = end_pos - start_pos
-                else:
-                    syntax_end_x = curr_syntax.end - start_pos
+            for syntax_start_x, syntax_end_x, syntax_style in syntax_map.get(buf_y, ()):
+                curr_style = syntax_style.as_dict() # do not change the syntax
 
                 # draw with default until the syntax portion
                 if x < syntax_start_x:
@@ -319,6 +323,7 @@ class Window():
                                     to_flush=True)
             y += 1
 
+    @single_frame
     def draw_cursor(self):
         if self.status_line: self.draw_status_line()
         if self.line_numbers: self.draw_line_numbers()
@@ -379,67 +384,30 @@ class Window():
                                 style)
 
     def highlight(self):
-        buffer_height = len(self.buffer.lines) - 1
-
         screen_start_y = self.buffer_cursor[1] - self.window_cursor[1]
-        screen_end_y = min(screen_start_y + self.content_height, buffer_height)
+        screen_end_y = min(screen_start_y + self.content_height, len(self.buffer.lines))
 
-        for scope, style in self.buffer.highlights:
-            if scope.start.y >= screen_end_y: return
-            if scope.end.y < screen_start_y: continue
-
-            # one line
-            if scope.start.y == scope.end.y:
-                string = self.get_line(scope.start.y)[scope.start.x:scope.end.x]
-
-                self._screen_write( self._expanded_x(scope.start.y, scope.start.x),
-                                    scope.start.y - screen_start_y,
-                                    string,
-                                    style)
-                continue
-
-            # first line
-            string = self.get_line(scope.start.y)[scope.start.x:]
-            self._screen_write( self._expanded_x(scope.start.y, scope.start.x),
-                                scope.start.y - screen_start_y,
-                                string,
-                                style)
-
-            # lines in between
-            for y in range(scope.start.y + 1, scope.end.y):
-                string = self.get_line(y)
-                self._screen_write( 0,
-                                    y - screen_start_y,
-                                    string,
-                                    style)
-
-            # last line
-            string = self.get_line(scope.end.y)[:scope.end.x]
-            self._screen_write( 0,
-                                scope.end.y - screen_start_y,
-                                string,
-                                style)
+        for highlight in self.buffer.highlights.values():
+            for y in range(screen_start_y, screen_end_y):
+                line = self.get_line(y)
+                for start_x, end_x in highlight.get(self.buffer.lines, y):
+                    self._screen_write( self._expanded_x(y, start_x),
+                                        y - screen_start_y,
+                                        line[start_x:end_x],
+                                        highlight.style)
 
     def get_syntax(self):
-        MAX_COLS = 1000
-        syntax_map = IntervalTree()
-        if not self.buffer.treesitter: return syntax_map
+        """ highlight runs (start_x, end_x, style) of the visible lines, by line """
+        if not self.buffer.syntax_cache: return {}
 
         buffer_height = len(self.buffer.lines) - 1
 
         screen_start_y = self.buffer_cursor[1] - self.window_cursor[1]
         screen_end_y = min(screen_start_y + self.content_height, buffer_height)
 
-        for node, style in get_syntax_highlights(   self.buffer.treesitter,
-                                                    start_point=(screen_start_y, 0),
-                                                    end_point=(screen_end_y+1, 0)):
-            start_pos = (node.start_point[0] * MAX_COLS) + node.start_point[1]
-            end_pos = (node.end_point[0] * MAX_COLS) + node.end_point[1]
-
-            if start_pos == end_pos: continue
-
-            syntax_map[start_pos:end_pos] = style
-        return syntax_map
+        return self.buffer.syntax_cache.get(self.buffer.lines,
+                                            screen_start_y,
+                                            screen_end_y)
 
     def _visualize_block(self):
         style = {}
@@ -580,23 +548,35 @@ class Window():
         except Exception as e:
             elog(f"[!] multi_cursors {e}")
 
-    def _get_curr_highlight_index(self):
+    def _get_highlights_status(self):
+        """
+        [index/total] of the match under the cursor, the totals are counted
+        by the buffer in the background and shown as they come.
+        """
+        highlights = list(self.buffer.highlights.values())
+        if len(highlights) == 0: return ""
+        counts = [self.buffer.match_count(highlight.pattern) for highlight in highlights]
+        if all(count.done and count.total == 0 for count in counts): return ""
+
         buf_x = self.buffer_cursor[0]
         buf_y = self.buffer_cursor[1]
-        index = "?"
-        for i, (scope, style) in enumerate(self.buffer.highlights):
-            if scope.start.x <= buf_x <= scope.end.x and \
-               scope.start.y <= buf_y <= scope.end.y:
-                index = str(i+1)
+        curr = None
+        offset = 0
+        for highlight, count in zip(highlights, counts):
+            index = count.index_of(highlight, self.buffer.lines, buf_x, buf_y)
+            if index:
+                curr = offset + index
                 break
-        return index
+            if not count.done or count.exceeded: break
+            offset += count.total
 
-    def _get_highlights_status(self):
-        total = len(self.buffer.highlights)
-        if total == 0: return ""
-        curr = self._get_curr_highlight_index()
-        return f"[{curr}/{total}]"
+        if len(counts) == 1: total = counts[0].status()
+        elif all(count.done and not count.exceeded for count in counts):
+            total = str(sum(count.total for count in counts))
+        else: total = f">{sum(count.total for count in counts)}"
+        return f"[{curr if curr else '?'}/{total}]"
 
+    @single_frame
     def draw_status_line(self):
         style = {}
         style['background'] = get_setting("status_line_background")
@@ -656,6 +636,8 @@ class Window():
             end_x = self.width - 1
             self._screen_clear_line_partial(y, start_x, end_x)
 
+    @scheduled
+    @single_frame
     def draw(self):
         debug = False
         self.screen.disable_cursor() # we do not want to see the cursor moves while we draw.
@@ -677,7 +659,6 @@ class Window():
                     self.screen.flush()
 
                 buffer_y = first_line + y
-                buffer_start_x = 0
 
                 # we at the end of the buffer, draw background.
                 if buffer_y > buffer_height:
@@ -690,51 +671,12 @@ class Window():
                 line = self.get_line(buffer_y)
                 buffer_end_x = max(0, len(line) - 1) # minus one because of '\n'
 
-                MAX_COLS = 1000
-                _start_pos = (buffer_y * MAX_COLS) + buffer_start_x
-                _end_pos = (buffer_y * MAX_COLS) + buffer_end_x
-
-                syntax = sorted(list(syntax_map[_start_pos:_end_pos]))
-
-                if debug:
-                    elog(f"syntax query: [{_start_pos},{_end_pos}]")
-                    for s in syntax: elog(f"\t{s}")
-
-                # there is not syntax, draw with default style.
-                if len(syntax) == 0:
-                    self._screen_write( self._expanded_x(buffer_y, x),
-                                        y,
-                                        line[:-1], # do not draw '\n'
-                                        default_style,
-                                        to_flush=debug)
-                    x += len(line) - 1
-                    # draw rest of window background.
-                    if x < self.screen.width:
-                        x_rest = self.content_width - x
-                        self._screen_write( self._expanded_x(buffer_y, x), y,
-                                            " "*x_rest,
-                                            default_style,
-                                            to_flush=debug)
-                    continue
-
                 # drawing with syntax highlights...:
-
-                while len(syntax) > 0:
+                for syntax_start_x, syntax_end_x, syntax_style in syntax_map.get(buffer_y, ()):
                     if debug:
                         time.sleep(0.1)
                         self.screen.flush()
 
-                    curr_syntax = syntax.pop(0)
-                    if curr_syntax.begin <= _start_pos:
-                        syntax_start_x = 0
-                    else:
-                        syntax_start_x = curr_syntax.begin - _start_pos
-
-                    if curr_syntax.end >= _end_pos:
-                        syntax_end_x = _end_pos - _start_pos
-                    else:
-                        syntax_end_x = curr_syntax.end - _start_pos
-
                     # draw with default until the syntax portion
                     if x < syntax_start_x:
                         self._screen_write( self._expanded_x(buffer_y, x), y,
@@ -745,7 +687,7 @@ class Window():
                     x = syntax_start_x
                     self._screen_write( self._expanded_x(buffer_y, x), y,
                                         line[syntax_start_x:syntax_end_x],
-                                        curr_syntax.data,
+                                        syntax_style,
                                         to_flush=debug)
                     x = syntax_end_x
                 # draw to the end of the window with default style
@@ -772,7 +714,9 @@ class Window():
             if self.status_line: self.draw_status_line()
             if self.line_numbers: self.draw_line_numbers()
             # is focused?
+            self._need_to_clear_pairs = False
             if self.tab.get_curr_window().id == self.id:
+                self._paint_pairs()
                 self._draw_cursor()
         except Exception as e:
             elog(f"Exception: {e}", type="ERROR")
@@ -905,6 +849,18 @@ class Window():
                 self.buffer_cursor[0] = line_len
         return True, scrolled
 
+    def _jump_to_line(self, buf_y):
+        """ put the cursor on line buf_y, scrolled as moving there line by line would """
+        window_y = self.window_cursor[1] + buf_y - self.buffer_cursor[1]
+        self.window_cursor[1] = max(0, min(window_y, self.content_height - 1))
+        self.buffer_cursor[1] = buf_y
+
+        line_len = len(self.buffer.lines[buf_y]) - 1
+        if line_len < self.window_cursor[0]:
+            self.remember = max(self.remember, self.window_cursor[0])
+            self.window_cursor[0] = line_len
+            self.buffer_cursor[0] = line_len
+
     def _move_right(self):
         if self.buffer_cursor[0] == len(self.buffer.lines[self.buffer_cursor[1]]) - 1:
             return
@@ -967,6 +923,12 @@ class Window():
 
         if self.is_visible(buf_x, buf_y):
             scrolled = False
+            y_diff = buf_y - self.buffer_cursor[1]
+            if abs(y_diff) > self.content_height:
+                # far away, go straight to the line next to it
+                self._jump_to_line(buf_y - (1 if y_diff > 0 else -1))
+                scrolled = True
+
             if self.buffer_cursor[1] > buf_y:
                 y_diff = self.buffer_cursor[1] - buf_y
                 for i in range(y_diff):
@@ -1127,13 +1089,12 @@ class Window():
         if re.match(r'^\s*$', line) or not keep_whitespaces: # if only whitespaces
             self.move_cursor_to_buf_location(0, y)
             # replace with empty line (including the newline char)
-            self.buffer.replace_line(y, "\n", propagate=False)
+            self.buffer.replace_line(y, "\n")
         else:
             indent = len(line) - len(line.lstrip())
             self.move_cursor_to_buf_location(indent, y)
             # replace with empty line (including the newline char)
-            self.buffer.replace_line(y, line[:indent]+'\n', propagate=False)
-        self.buffer.flush_changes()
+            self.buffer.replace_line(y, line[:indent]+'\n')
 
     def remove_line(self):
         to_remove = self.buffer_cursor[1]
@@ -1159,30 +1120,30 @@ class Window():
                         end_y,
                         is_right):
         indent_content = get_setting('tab_insert')
-        if is_right:
-            for y in range(start_y, end_y + 1):
-                line = self.get_line(y)
-                if len(line) - 1 <= 0: continue
-                if not re.search(r'\S', line): continue
-                line = indent_content + line
-                self.buffer.replace_line(y, line, propagate=False)
-            curr_y = self.buffer_cursor[1]
-            if start_y <= self.buffer_cursor[1] < end_y + 1:
-                for i in range(len(indent_content)):
-                    self._move_right()
-        else:
-            for y in range(start_y, end_y + 1):
-                line = self.get_line(y)
-                if len(line) - 1 <= 0: continue
-                m = re.search(r'\S', line)
-                if not m: continue
-                num_of_spaces = m.start()
-                num_to_remove = min(len(indent_content), num_of_spaces)
-                self.buffer.replace_line(y, line[num_to_remove:], propagate=False)
-                if self.buffer_cursor[1] == y:
-                    for i in range(num_to_remove):
-                        self._move_left()
-        self.buffer.flush_changes()
+        with self.buffer.batch():
+            if is_right:
+                for y in range(start_y, end_y + 1):
+                    line = self.get_line(y)
+                    if len(line) - 1 <= 0: continue
+                    if not re.search(r'\S', line): continue
+                    line = indent_content + line
+                    self.buffer.replace_line(y, line)
+                curr_y = self.buffer_cursor[1]
+                if start_y <= self.buffer_cursor[1] < end_y + 1:
+                    for i in range(len(indent_content)):
+                        self._move_right()
+            else:
+                for y in range(start_y, end_y + 1):
+                    line = self.get_line(y)
+                    if len(line) - 1 <= 0: continue
+                    m = re.search(r'\S', line)
+                    if not m: continue
+                    num_of_spaces = m.start()
+                    num_to_remove = min(len(indent_content), num_of_spaces)
+                    self.buffer.replace_line(y, line[num_to_remove:])
+                    if self.buffer_cursor[1] == y:
+                        for i in range(num_to_remove):
+                            self._move_left()
         self.draw_cursor()
 
     def remove_scope(self, scope):
@@ -1242,9 +1203,8 @@ class Window():
             self._move_left()
 
     def remove_chars(self, num):
-        for i in range(num):
-            self._remove_char(propagate=False)
-        self.buffer.flush_changes()
+        with self.buffer.batch():
+            for i in range(num): self._remove_char()
         self.draw_cursor()
 
     def remove_char(self):
@@ -1267,15 +1227,13 @@ class Window():
         self._move_left()
         self.buffer.replace_char(   self.buffer_cursor[0],
                                     self.buffer_cursor[1],
-                                    char, propagate=False)
-        self.buffer.flush_changes()
+                                    char)
         self.draw_cursor()
 
     def replace_char_forward(self, char, to_draw=True):
         self.buffer.replace_char(   self.buffer_cursor[0],
                                     self.buffer_cursor[1],
-                                    char, propagate=False)
-        self.buffer.flush_changes()
+                                    char)
         if char == '\n' or char == '\r':
             ret = self._move_down()
             if ret and ret[1]:
@@ -1289,10 +1247,11 @@ class Window():
         self._insert_char(char)
         self.draw_cursor()
 
-    def insert_string(self, string):
+    def insert_string(self, string, keep_indent=True):
         x, y = self.buffer.insert_string(   self.buffer_cursor[0],
                                             self.buffer_cursor[1],
-                                            string)
+                                            string,
+                                            keep_indent=keep_indent)
 
         self.move_cursor_to_buf_location(   x,
                                             y)
@@ -1344,6 +1303,18 @@ class Window():
         self.move_cursor_to_buf_location(   position[0],
                                             position[1])
 
+    def earlier(self):
+        position = self.buffer.earlier()
+        if not position: return
+        self.move_cursor_to_buf_location(   position[0],
+                                            position[1])
+
+    def later(self):
+        position = self.buffer.later()
+        if not position: return
+        self.move_cursor_to_buf_location(   position[0],
+                                            position[1])
+
     def visual_begin(self, mode):
         self.buffer.visual_begin(   mode,
                                     self.buffer_cursor[0],
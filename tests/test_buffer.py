@@ -0,0 +1,29 @@
+from fork.buffer import Buffer
+
+
+def make_buffer(count):
+    return Buffer(data_in_bytes=''.join(f"line {y}\n" for y in range(count)).encode())
+
+def test_undo_after_drop_lines():
+    buffer = make_buffer(30)
+    buffer.change_begin(0, 15)
+    buffer.replace_line(15, "EDITED\n")
+    buffer.change_end(0, 15)
+
+    buffer.drop_lines(10)
+    assert buffer.lines[5] == "EDITED\n"
+
+    assert buffer.undo() == (0, 5)
+    assert list(buffer.lines) == [f"line {y}\n" for y in range(10, 30)]
+    assert buffer.redo() == (0, 5)
+    assert buffer.lines[5] == "EDITED\n"
+
+def test_drop_lines_clears_history_of_dropped_lines():
+    buffer = make_buffer(30)
+    buffer.change_begin(0, 5)
+    buffer.replace_line(5, "EDITED\n")
+    buffer.change_end(0, 5)
+
+    buffer.drop_lines(10)
+    assert buffer.undo() is None
+    assert list(buffer.lines) == [f"line {y}\n" for y in range(10, 30)]
@@ -0,0 +1,13 @@
+from fork.treesitter import TreeSitter
+
+SOURCE = 'def f():\n    s = "éééééé"; g(a, b)\n'
+
+
+def test_node_at_multi_byte_line():
+    lines = SOURCE.splitlines(keepends=True)
+    treesitter = TreeSitter(SOURCE.encode(), 'python', lambda: lines)
+
+    x = lines[1].index('a')
+    node = treesitter._node_at(x, 1, ('argument_list',))
+    assert node is not None
+    assert node.start_point == (1, len(lines[1][:lines[1].index('(')].encode()))